@@ -1,16 +1,23 @@
+import argparse
 import codecs
+import csv
 import sys
 import configparser
 import time
 import json
 import os
+import re
 import errno
-from socket import timeout
-from urllib.request import urlopen
-from urllib.error import URLError, HTTPError
-from requests.exceptions import ConnectionError
-from shutil import copyfile
-from bs4 import BeautifulSoup
+import gzip
+import hashlib
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, unquote
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from shutil import copyfile, copyfileobj
 from datetime import datetime
 import sqlite3
 
@@ -21,19 +28,51 @@ try:
     # noinspection PyUnresolvedReferences
     from plexapi.server import PlexServer
     # noinspection PyUnresolvedReferences
-    from plexapi.exceptions import NotFound
+    from plexapi.exceptions import NotFound, PlexApiException
     plex_api_installed = True
 except ImportError:
     plex_api_installed = False
     print('Plex api is not installed.')
 
+# optional, only needed for zstd compressed backups:
+# pip install zstandard
+
+try:
+    # noinspection PyUnresolvedReferences
+    import zstandard
+    zstandard_installed = True
+except ImportError:
+    zstandard_installed = False
+
+# optional, scores the collections faster:
+# pip install numpy
+
+try:
+    # noinspection PyUnresolvedReferences
+    import numpy
+    numpy_installed = True
+except ImportError:
+    numpy_installed = False
+
 
 # global static variables:
+# command line stuff
+argument_parser = argparse.ArgumentParser(description='Edits the Plex database as set up in config.cfg.')
+plan_arguments = argument_parser.add_mutually_exclusive_group()
+plan_arguments.add_argument('--plan-out', metavar='FILE',
+                            help='save the planned changes to FILE (.json or .ndjson) in stead of writing them.')
+plan_arguments.add_argument('--apply', metavar='FILE',
+                            help='write the changes planned with --plan-out to the database.')
+arguments = argument_parser.parse_args()
+
 # config stuff
 config_file = 'config.cfg'
 with codecs.open(os.path.join(os.path.dirname(sys.argv[0]), config_file), 'r', 'utf-8') as open_config_file:
     config = configparser.ConfigParser()
     config.read_file(open_config_file)
+for optional_section in ('CACHE', 'NETWORK'):
+    if not config.has_section(optional_section):
+        config.add_section(optional_section)
 global_settings = config['GLOBAL_SETTINGS']
 if global_settings.getboolean('safety_lock', True):
     print('safety_lock is activated! Exiting.')
@@ -43,6 +82,12 @@ if global_settings.getboolean('safety_lock', True):
 tmdb_api_key = global_settings['tmdb_api_key']
 main_language = global_settings['main_tmdb_language']
 secondary_language = global_settings.get('secondary_tmdb_language')
+fallback_languages = [language.strip() for language in global_settings.get('fallback_tmdb_languages', '').split(',')
+                      if language.strip() != '']
+tmdb_languages = list()               # every language, in the order they are tried.
+for tmdb_language in [main_language, secondary_language] + fallback_languages:
+    if tmdb_language is not None and tmdb_language != '' and tmdb_language not in tmdb_languages:
+        tmdb_languages.append(tmdb_language)
 
 # database stuff
 plex_home_dir = global_settings.get('plex_home_directory')
@@ -52,10 +97,48 @@ database_backup_dir = global_settings.get('database_backup_dir', os.path.join(pl
                                                                               'Plug-in Support',
                                                                               'Databases.PlexUnify.Backups',
                                                                               'Database-Backup'))
-database = sqlite3.connect(database_dir)
+database = sqlite3.connect(database_dir, timeout=global_settings.getfloat('busy_timeout', 5))
 cursor = database.cursor()
 main_cursor = database.cursor()
 
+# cache stuff
+cache_settings = config['CACHE']
+cache_file = cache_settings.get('cache_file', os.path.join(plex_home_dir, 'Plug-in Support',
+                                                           'PlexUnify.Cache', 'tmdb-cache.db'))
+image_store_dir = cache_settings.get('image_store_dir', os.path.join(plex_home_dir, 'Plug-in Support',
+                                                                     'PlexUnify.Cache', 'Images'))
+
+# image sizes available on tmdb
+poster_sizes = ('w92', 'w154', 'w185', 'w342', 'w500', 'w780', 'original')
+backdrop_sizes = ('w300', 'w780', 'w1280', 'original')
+
+# certificate links on the imdb parental guide. example: /search/title?certificates=SE:15
+imdb_certificate_pattern = re.compile(rb'/search/title\?certificates=([A-Za-z]+):([^"&:<>]+)')
+
+# network stuff
+network_settings = config['NETWORK']
+
+# extra data asked for in the same request as the metadata, so one request per movie and per collection
+# covers every category and every language.
+tmdb_appends = {'movie': list(), 'collection': list()}
+if network_settings.getboolean('combine_tmdb_requests', True) and len(tmdb_languages) > 1:
+    if any(config[section].getboolean('enable_category', False) for section in
+           ('ORIGINAL_TITLE_SETTINGS', 'TAGLINE_SETTINGS', 'COLLECTIONS_SETTINGS')):
+        tmdb_appends['movie'].append('translations')
+    if config['COLLECTIONS_SETTINGS'].getboolean('enable_category', False):
+        tmdb_appends['collection'].append('translations')
+if config['CONTENT_RATING_SETTINGS'].getboolean('enable_category', False) \
+        and config['CONTENT_RATING_SETTINGS'].get('content_rating_source', 'imdb') == 'tmdb':
+    tmdb_appends['movie'].append('release_dates')
+
+# incremental mode stuff
+state_file = global_settings.get('state_file', os.path.join(plex_home_dir, 'Plug-in Support',
+                                                            'PlexUnify.Cache', 'state.json'))
+
+# resume stuff
+journal_file = global_settings.get('journal_file', os.path.join(plex_home_dir, 'Plug-in Support',
+                                                                'PlexUnify.Cache', 'journal.json'))
+
 # plex api stuff
 library_key = None
 if plex_api_installed:
@@ -92,10 +175,7 @@ if library_key is None:
 
 # global variables:
 
-tmdb_movie_metadata = None
-secondary_tmdb_movie_metadata = None
-tmdb_collection_metadata = None
-secondary_tmdb_collection_metadata = None
+tmdb_movie_metadata = dict()      # metadata of the current movie. example: 'sv-SE': {tmdb movie metadata}
 
 metadata_items_commits = dict()   #
 taggings_commits = dict()         #
@@ -105,6 +185,44 @@ tags_commits = dict()             # list of changes to be made on tables. exampl
 delete_commits = list()           # list of entries to be deleted. example: [20, 3201]
 
 taggings_insert_commits = dict()  # list of added entries to tables. example: 20: {dict of added entries}
+
+prefetched_pages = dict()         # pages downloaded ahead of the movie loop. example: url: b'page content'
+keep_retrieved_pages = False      # pages downloaded while set are kept in prefetched_pages for the movie loop.
+cache_database = None             # connection to the tmdb cache, opened on first use.
+imdb_certificates = dict()        # certificates found on imdb. example: 'tt0123456': {'SE': '15', 'US': 'R'}
+offline_content_ratings = None    # ratings from the content rating file. example: 'tt0123456': '15', '603': '15'
+movie_id_map = dict()             # tmdb id of imdb ids, None if tmdb has no match. example: 'tt0133093': '603'
+imdb_id_map = dict()              # imdb id of tmdb ids. example: '603': 'tt0133093'
+
+processed_movie_ids = list()      # movies that were processed without errors. example: [20, 21]
+run_state = None                  # what the last run saw and did, used by incremental mode.
+
+rate_limit_buckets = dict()       # token bucket per host. example: 'api.themoviedb.org': {dict of bucket state}
+rate_limit_lock = threading.Lock()
+
+connection_lost_event = threading.Event()
+
+http_session = None               # shared keep-alive session for all downloads, created on first use.
+http_session_lock = threading.Lock()
+
+image_download_queue = dict()     # images to download before committing. example: target path: (url, name)
+symlink_queue = list()            # movie images to symlink into collections when planning. example: [source, target, id]
+planned_collections = list()      # collections to create when planning. example: ['Star Wars', 20, 10]
+
+collection_registry = dict()      # collections resolved during this run. example: tmdb collection id: {dict of data}
+
+library_movies = None             # metadata_items rows of every movie in the library. example: 20: (row)
+collection_members = None         # movies tagged with each collection tag. example: 3201: [20, 21]
+library_collections = None        # collection rows by title without suffix, case folded. example: 'star wars': [(row)]
+
+genre_tags = None                 # genre tags by lower case name. example: 'drama': 12
+genre_taggings = None             # genre taggings by movie. example: 20: {tagging id: tag id}
+
+rating_names = None               # the [RATINGS] table names in order. example: ('barntillåten', 'whatever')
+rating_name_set = None            # the same names, for lookups.
+rating_renames = None             # what each real rating, in lower case, ends up as. example: 'btl': 'barntillåten'
+genre_renames = None              # the [GENRES] table. example: (('action', ('action-movie', 'act')), ...)
+collection_suffix_trie = None     # collection suffixes, lower case and backwards. example: 'n': {'e': {...}}
 # end of global variables.
 
 
@@ -112,10 +230,12 @@ def main():
 
     def get_movie_data(metadata_id):
 
-        cursor.execute('SELECT id, guid, title, original_title, tagline, content_rating, user_fields, hash '
-                       'FROM metadata_items '
-                       'WHERE id = ? ', (metadata_id,))
-        movie_info = cursor.fetchone()
+        movie_info = library_movies.get(metadata_id)
+        if movie_info is None:
+            cursor.execute('SELECT id, guid, title, original_title, tagline, content_rating, user_fields, hash '
+                           'FROM metadata_items '
+                           'WHERE id = ? ', (metadata_id,))
+            movie_info = cursor.fetchone()
         movie_ret = dict()
         movie_ret['metadata_id'] = movie_info[0]
         movie_ret['guid'] = movie_info[1]
@@ -136,10 +256,10 @@ def main():
 
         if ".themoviedb" in movie_ret['guid']:
             movie_ret['tmdb_id'] = movie_ret['guid'].split('//')[1].split('?')[0]
-            movie_ret['imdb_id'] = None
+            movie_ret['imdb_id'] = imdb_id_map.get(movie_ret['tmdb_id'])
         elif ".imdb" in movie_ret['guid']:
-            movie_ret['tmdb_id'] = None
             movie_ret['imdb_id'] = movie_ret['guid'].split('//')[1].split('?')[0]
+            movie_ret['tmdb_id'] = movie_id_map.get(movie_ret['imdb_id'])
         else:
             movie_ret['no_id'] = True
             movie_ret['no_tmdb_id'] = True
@@ -186,56 +306,16 @@ def main():
 
         def get_metadata_holder():
 
-            global secondary_tmdb_collection_metadata
-            global tmdb_collection_metadata
-
-            if settings.getboolean('prefer_secondary_language'):
-                if secondary_tmdb_movie_metadata is None:
-                    get_secondary_tmdb_movie_metadata(movie)
-                movie_metadata = secondary_tmdb_movie_metadata
-            else:
-                if tmdb_movie_metadata is None:
-                    get_tmdb_movie_metadata(movie)
-                movie_metadata = tmdb_movie_metadata
-
-            if movie_metadata['belongs_to_collection'] is None:
-                return None
-
-            collection_ret['collection_id'] = movie_metadata['belongs_to_collection']['id']
-            collection_ret['title'] = movie_metadata['belongs_to_collection']['name']
-
-            if settings.getboolean('prefer_secondary_language'):
-                get_secondary_tmdb_collection_metadata(collection_ret)
-                coll_metadata = secondary_tmdb_collection_metadata
-            else:
-                get_tmdb_collection_metadata(collection_ret)
-                coll_metadata = tmdb_collection_metadata
-
-            return coll_metadata
-
-        def trim_suffix(title):
-            suffix_list = settings.get('collection_suffixes_to_remove')
-            suffix_list = suffix_list.replace(' ', '')
-            suffix_list = suffix_list.split(',')
-            for suffix in suffix_list:
-                if title.lower().endswith(suffix.lower()):
-                    title = title[:-(len(suffix) + 1)]
-                    break
-            return title
+            return get_tmdb_collection_of_movie(movie, collection_ret, settings)
 
         def is_viable():
 
-            movies_above_score_threshold = 0
-            total_score = 0
-            for coll_movie in current_collection_metadata_holder['parts']:
-                if coll_movie['vote_count'] > settings.getint('minimum_movie_vote_count'):
-                    if coll_movie['vote_average'] >= settings.getfloat('minimum_movie_score', 0):
-                        movies_above_score_threshold += 1
-                total_score += coll_movie['vote_average']
-
-            stat1 = total_score >= settings.getint('minimum_total_score')
-            stat2 = movies_above_score_threshold >= settings.getint('minimum_movie_count')
-            if not (stat1 and stat2):
+            if 'viable' in registered_collection:
+                return registered_collection['viable']
+
+            score_collections([collection_ret['collection_id']], settings)
+            registered_collection['viable'] = registered_collection['score']['viable']
+            if not registered_collection['viable']:
                 if settings.getboolean('enable_automatic_deletion', False):
                     delete_collection(collection_ret, settings.get('delete_locked_less_than'))
                 return False
@@ -243,42 +323,32 @@ def main():
             return True
 
         def get_collection_info():
-            global library
+
+            # plex changes the movie the collection was created with.
+            if registered_collection.get('created_with') == movie['metadata_id']:
+                movie['user_fields_compare'] = 'force_push'
+
+            if registered_collection.get('info') is not None:
+                return registered_collection['info']
+
+            # new collections are created ahead of time by prepare_collections.
             coll_info = None
-            created_collection = False
-            for i in range(5):
-
-                cursor.execute('SELECT id, content_rating, user_fields, [index], hash, summary '
-                               'FROM metadata_items '
-                               'WHERE metadata_type = 18 '
-                               'AND library_section_id = ? '
-                               'AND title = ? ', (library_key, collection_ret['title'],))
-                coll_info = cursor.fetchone()
-                if coll_info is None:
-                    if not created_collection:
-                        created_collection = True
-                        if settings.getboolean('add_new_collections') or settings.getboolean('force'):
-                            if plex_api_installed:
-                                library.get(movie['title']).addCollection(collection_ret['title'])
-                                database.commit()
-                                movie['user_fields_compare'] = 'force_push'
-                            else:
-                                print('Unable to create new collection because Plex api is unavailable. Skipping')
-                                return None
-
-                        else:
-                            print('Not allowed to create new collections. Skipping')
-                            return None
-                    else:
-                        print('Waiting for database to add collection: "' + collection_ret['title'] + '"')
-                        time.sleep(1)
-                        database.commit()
-                else:
-                    break
+            for coll_info in get_collections_by_title(collection_ret['title']):
+                break
             if coll_info is None:
-                print('was unable to find collection: "' + collection_ret['title'] + '". Skipping')
+                if any(get_collection_title_key(collection_ret['title']) ==
+                       get_collection_title_key(planned_collection[0]) for planned_collection in planned_collections):
+                    print('The collection "' + collection_ret['title'] + '" is created when the plan is applied. '
+                          'Run the script again after that to fill it in. Skipping')
+                elif not settings.getboolean('add_new_collections') and not settings.getboolean('force'):
+                    print('Not allowed to create new collections. Skipping')
+                elif not plex_api_installed:
+                    print('Unable to create new collection because Plex api is unavailable. Skipping')
+                else:
+                    print('was unable to find collection: "' + collection_ret['title'] + '". Skipping')
                 return None
 
+            registered_collection['info'] = coll_info
             return coll_info
 
         collection_ret = dict()
@@ -291,6 +361,8 @@ def main():
         if current_collection_metadata_holder is None:
             return None
 
+        registered_collection = register_collection(collection_ret['collection_id'])
+
         collection_ret['title'] = trim_suffix(collection_ret['title'])
 
         if not is_viable():
@@ -315,26 +387,22 @@ def main():
 
         collection_ret['metadata_items_jobs'] = dict()
 
-        cursor.execute('SELECT taggings.metadata_item_id '
-                       'FROM tags '
-                       'INNER JOIN taggings '
-                       'ON tags.tag_type = 2 '
-                       'AND tags.id = taggings.tag_id '
-                       'AND tags.id = ?', (collection_ret['index'],))
-        for movie_id in cursor.fetchall():
-            if movie_id[0] != movie['metadata_id']:
-                collection_ret['movies_in_collection'].append(get_movie_data(movie_id[0]))
+        if 'members' not in registered_collection:
+            registered_collection['members'] = dict()
+            for member_id in get_collection_members(collection_ret['index']):
+                registered_collection['members'][member_id] = None
+        for member_id in registered_collection['members']:
+            if member_id != movie['metadata_id']:
+                if registered_collection['members'][member_id] is None:
+                    registered_collection['members'][member_id] = get_movie_data(member_id)
+                collection_ret['movies_in_collection'].append(registered_collection['members'][member_id])
 
         if not settings.getboolean('force'):
             if settings.getboolean('respect_lock'):
                 if '16' in movie['user_fields']:
                     return collection_ret
 
-        cursor.execute('SELECT id '
-                       'FROM taggings '
-                       'WHERE metadata_item_id = ? '
-                       'AND tag_id = ?', (movie['metadata_id'], collection_ret['index'],))
-        if cursor.fetchone() is not None:
+        if movie['metadata_id'] in get_collection_members(collection_ret['index']):
             return collection_ret
 
         add_to_insert_commit_list(taggings_insert_commits,
@@ -352,6 +420,66 @@ def main():
 
         return collection_ret
 
+    def prepare_collections(batch_movie_ids):
+        # Finds the collections the movies will be added to and scores them all at once, before the movies
+        # are processed. The viable ones that aren't in plex yet are created in one go, each with its first movie.
+        # The movies are fetched by rating key and the new collections are read back from the database with one query.
+        global keep_retrieved_pages
+
+        collection_settings = config['COLLECTIONS_SETTINGS']
+        if not collection_settings.getboolean('enable_category', False):
+            return
+
+        candidates = dict()  # example: tmdb collection id: ('Star Wars', first movie metadata id)
+        for metadata_id in batch_movie_ids:
+            movie_info = library_movies.get(metadata_id)
+            if movie_info is None or ('.themoviedb' not in movie_info[1] and '.imdb' not in movie_info[1]):
+                continue
+            new_collection = dict()
+            try:
+                # the movie loop asks for the same pages again, they are kept so they aren't downloaded twice.
+                keep_retrieved_pages = True
+                collection_metadata = get_tmdb_collection_of_movie(get_movie_data(metadata_id), new_collection,
+                                                                   collection_settings)
+            except ValueError:
+                # the movie loop will run into it again and report it.
+                continue
+            finally:
+                keep_retrieved_pages = False
+                tmdb_movie_metadata.clear()
+            if collection_metadata is None or new_collection['collection_id'] in candidates:
+                continue
+            candidates[new_collection['collection_id']] = (trim_suffix(new_collection['title']), metadata_id)
+
+        if len(candidates) == 0:
+            return
+        score_collections(list(candidates), collection_settings)
+        viable_collections = [collection_id for collection_id in candidates
+                              if collection_registry[collection_id]['score']['viable']]
+        print(str(len(viable_collections)) + ' of ' + str(len(candidates)) +
+              ' collections the movies belong to are viable.')
+
+        if not plex_api_installed:
+            return
+        if not collection_settings.getboolean('add_new_collections') and not collection_settings.getboolean('force'):
+            return
+
+        new_collections = dict()  # example: 'star wars': ('Star Wars', first movie metadata id, tmdb collection id)
+        for collection_id in viable_collections:
+            title, metadata_id = candidates[collection_id]
+            if get_collection_title_key(title) in new_collections or len(get_collections_by_title(title)) > 0 \
+                    or any(get_collection_title_key(title) == get_collection_title_key(planned_collection[0])
+                           for planned_collection in planned_collections):
+                continue
+            new_collections[get_collection_title_key(title)] = (title, metadata_id, collection_id)
+
+        if arguments.plan_out is not None:
+            # nothing is created while planning, apply_plan creates them.
+            print(str(len(new_collections)) + ' new collections will be created when the plan is applied.')
+            planned_collections.extend(list(new_collection) for new_collection in new_collections.values())
+            return
+        create_collections(list(new_collections.values()))
+
     def report_collection_to_commit():
 
         temp = list()
@@ -370,75 +498,163 @@ def main():
         if len(collection['metadata_items_jobs']) != 0:
             metadata_items_commits[collection['metadata_id']] = collection['metadata_items_jobs']
 
-    global tmdb_movie_metadata
-    global secondary_tmdb_movie_metadata
-    global tmdb_collection_metadata
-    global secondary_tmdb_collection_metadata
-
-    # Backup Database.
-    backup_database(database_dir, database_backup_dir)
+    # Backup Database. Nothing is written when only planning.
+    if arguments.plan_out is None:
+        backup_database(database_dir, database_backup_dir)
 
+    # In incremental mode the limit is applied after unchanged movies are filtered out.
+    modify_limit = global_settings.getint('modify_limit', 30)
+    incremental_mode = global_settings.getboolean('incremental_mode', False)
     cursor.execute('SELECT id '
                    'FROM metadata_items '
                    'WHERE library_section_id = ? '
                    'AND metadata_type = 1 '
                    'ORDER BY created_at DESC ' 
-                   'LIMIT ?', (library_key, str(global_settings.getint('modify_limit', 30)),))
+                   'LIMIT ?', (library_key, str(-1 if incremental_mode else modify_limit),))
+    movie_ids = [movie_id[0] for movie_id in cursor.fetchall()]
+
+    load_library_snapshot()
+    load_movie_id_map()
+    if incremental_mode:
+        load_run_state()
+        changed_movie_ids = [movie_id for movie_id in movie_ids if has_movie_changed(movie_id)]
+        print('Incremental mode: ' + str(len(movie_ids) - len(changed_movie_ids)) + ' of ' + str(len(movie_ids)) +
+              ' movies are unchanged since the last run and will be skipped.')
+        movie_ids = changed_movie_ids
+        if modify_limit >= 0:
+            movie_ids = movie_ids[:modify_limit]
+    if config['GENRES_SETTINGS'].getboolean('enable_category', False):
+        load_genre_index()
+    if config['CONTENT_RATING_SETTINGS'].getboolean('enable_category', False):
+        load_offline_content_ratings()
+
+    start_index = load_journal(movie_ids)
+    batch_size = max(global_settings.getint('prefetch_batch_size', 50), 1)
+    checkpoint_interval = max(global_settings.getint('checkpoint_interval', 25), 1)
+    last_movie_id = movie_ids[start_index - 1] if start_index > 0 else None
+    interrupted = False
+    try:
+        if start_index < len(movie_ids):
+            look_up_missing_movie_ids()
 
-    for current_movie_id in cursor.fetchall():
+        for current_movie_index in range(start_index, len(movie_ids)):
+            current_movie_id = movie_ids[current_movie_index]
 
-        movie = get_movie_data(current_movie_id[0])
+            if (current_movie_index - start_index) % batch_size == 0:
+                prefetched_pages.clear()
+                imdb_certificates.clear()
+                prefetch_web_pages(movie_ids[current_movie_index:current_movie_index + batch_size])
+                prepare_collections(movie_ids[current_movie_index:current_movie_index + batch_size])
 
-        process_movie(movie)
+            movie = get_movie_data(current_movie_id)
 
-        settings = config['COLLECTIONS_SETTINGS']
-        if settings.getboolean('enable_category') and not movie['no_id'] and not movie['no_tmdb_id']:
-            try:
-                collection = get_collection_data()
-            except ValueError as e:
-                print(e)
-            else:
-                if collection is not None:
-                    process_collection(collection)
+            process_movie(movie)
+
+            settings = config['COLLECTIONS_SETTINGS']
+            if settings.getboolean('enable_category') and not movie['no_id'] and not movie['no_tmdb_id']:
+                try:
+                    collection = get_collection_data()
+                except ValueError as e:
+                    print(e)
+                    movie['failed'] = True
+                else:
+                    if collection is not None:
+                        process_collection(collection)
 
-                    report_collection_to_commit()
+                        report_collection_to_commit()
 
-        report_movie_to_commit()
+            report_movie_to_commit()
+            if not movie.get('failed', False):
+                processed_movie_ids.append(movie['metadata_id'])
+            last_movie_id = current_movie_id
 
-        tmdb_movie_metadata = None
-        secondary_tmdb_movie_metadata = None
-        tmdb_collection_metadata = None
-        secondary_tmdb_collection_metadata = None
+            tmdb_movie_metadata.clear()
 
-    # Commit to database.
-    commit_to_database()
+            if (current_movie_index - start_index + 1) % checkpoint_interval == 0:
+                save_journal(last_movie_id)
+
+    except (KeyboardInterrupt, ConnectionLostError) as e:
+        interrupted = True
+        print('-----------------------------------------------------------')
+        print('Stopped early: ' + (str(e) or 'interrupted by the user.'))
+        print('The progress is saved, the next run will continue after the last processed movie.')
+        print('-----------------------------------------------------------')
+        save_journal(last_movie_id)
+
+    prefetched_pages.clear()
+    imdb_certificates.clear()
+    if arguments.plan_out is None:
+        # when planning the images are downloaded by apply_plan, nothing is put in the plex folders before that.
+        download_queued_images()
+    trim_cache()
+    print_rate_limit_stats()
+
+    # Commit to database, or save the plan for later.
+    if save_plan(arguments.plan_out) if arguments.plan_out is not None else commit_to_database():
+        if interrupted:
+            # Only the position is left to save, the planned changes are written.
+            for commit_list in (metadata_items_commits, taggings_commits, tags_commits, taggings_insert_commits,
+                                delete_commits, processed_movie_ids, image_download_queue, symlink_queue,
+                                planned_collections):
+                commit_list.clear()
+            save_journal(last_movie_id)
+        else:
+            remove_journal()
+    elif not interrupted:
+        # the run got to the end but nothing was written, the next run plans everything again.
+        remove_journal()
 
     return
 
 
 def backup_database(source_dir, target_dir):
+    # Backs up the database with the sqlite backup api, a few pages at a time so Plex can keep writing meanwhile,
+    # and optionally compresses it. Older backups are shifted back by renaming them.
+
+    compression = global_settings.get('backup_compression', 'none').lower()
+    if compression == 'zstd' and not zstandard_installed:
+        print('zstandard is not installed, compressing the backup with gzip in stead.')
+        compression = 'gzip'
+    if compression not in ('none', 'gzip', 'zstd'):
+        raise ValueError('"' + compression + '" is not a valid backup_compression. Use none, gzip or zstd.')
+    suffix = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}[compression]
 
     if not os.path.isdir(os.path.split(target_dir)[0]):
         os.makedirs(os.path.split(target_dir)[0], mode=0o777, exist_ok=True)
 
-    if os.path.isfile(target_dir):
+    start_time = time.time()
+    source = sqlite3.connect(source_dir, timeout=global_settings.getfloat('busy_timeout', 5))
+    backup = sqlite3.connect(target_dir + '.tmp')
+    try:
+        source.backup(backup, pages=max(global_settings.getint('backup_pages_per_step', 1024), 1), sleep=0.005)
+    finally:
+        backup.close()
+        source.close()
+    database_size = os.path.getsize(target_dir + '.tmp')
+
+    if compression != 'none':
+        with open(target_dir + '.tmp', 'rb') as open_backup_file:
+            if compression == 'gzip':
+                with gzip.open(target_dir + suffix + '.tmp', 'wb', compresslevel=6) as open_compressed_file:
+                    copyfileobj(open_backup_file, open_compressed_file, 1024 * 1024)
+            else:
+                with open(target_dir + suffix + '.tmp', 'wb') as open_compressed_file:
+                    zstandard.ZstdCompressor().copy_stream(open_backup_file, open_compressed_file)
+        os.remove(target_dir + '.tmp')
 
+    if os.path.isfile(target_dir + suffix):
         for i in reversed(range(global_settings.getint('backups_to_keep', 5) - 1)):
-            if os.path.isfile(target_dir + '-' + str(i)):
-                copyfile(target_dir + '-' + str(i), target_dir + '-' + str(i + 1))
-        copyfile(target_dir, target_dir + '-0')
-    copyfile(source_dir, target_dir)
+            if os.path.isfile(target_dir + '-' + str(i) + suffix):
+                os.replace(target_dir + '-' + str(i) + suffix, target_dir + '-' + str(i + 1) + suffix)
+        os.replace(target_dir + suffix, target_dir + '-0' + suffix)
+    os.replace(target_dir + suffix + '.tmp', target_dir + suffix)
 
+    print('Backed up the database (' + str(round(database_size / 1024 / 1024, 1)) + ' MB, ' +
+          str(round(os.path.getsize(target_dir + suffix) / 1024 / 1024, 1)) + ' MB on disk) in ' +
+          str(round(time.time() - start_time, 2)) + ' seconds.')
 
-def process_movie(movie):
 
-    def check_main_language_metadata():
-        if tmdb_movie_metadata is None:
-            get_tmdb_movie_metadata(movie)
-
-    def check_secondary_language_metadata():
-        if secondary_tmdb_movie_metadata is None:
-            get_secondary_tmdb_movie_metadata(movie)
+def process_movie(movie):
 
     def change_original_titles():
 
@@ -447,14 +663,9 @@ def process_movie(movie):
                 if any("3" == s for s in movie['user_fields']):
                     return
 
-        if settings.getboolean('prefer_secondary_language'):
-            check_secondary_language_metadata()
-            original_title = secondary_tmdb_movie_metadata['original_title']
-            added_title = secondary_tmdb_movie_metadata['title']
-        else:
-            check_main_language_metadata()
-            original_title = tmdb_movie_metadata['original_title']
-            added_title = tmdb_movie_metadata['title']
+        movie_metadata = get_tmdb_movie_metadata(movie, get_tmdb_languages(settings)[0])
+        original_title = movie_metadata['original_title']
+        added_title = movie_metadata['title']
 
         if original_title in added_title or added_title in original_title:
             new_original_title = None
@@ -473,36 +684,35 @@ def process_movie(movie):
             if settings.getboolean('respect_lock'):
                 if any("8" == s for s in movie['user_fields']):
                     return
-            if any(movie['content_rating'] == s for s in config['RATINGS']):
+            if movie['content_rating'] in rating_name_set:
                 return
             if movie['content_rating'].lower() == settings['unknown_content_rating'].lower():
                 return
 
-        if movie['imdb_id'] is None:
-            get_tmdb_movie_metadata(movie)
+        content_rating = None
+        if settings.get('content_rating_source', 'imdb') == 'file':
+            content_rating = get_offline_content_rating(movie)
+            if content_rating is None and not settings.getboolean('fall_back_to_imdb', False):
+                print('The movie "' + movie['title'] + '" don\'t have a content rating in the content rating file.')
+                content_rating = ':-???-:'
+        elif settings.get('content_rating_source', 'imdb') == 'tmdb':
+            content_rating = get_tmdb_content_rating(get_tmdb_movie_metadata(movie),
+                                                     settings['content_rating_country_code'])
+            if content_rating is None and not settings.getboolean('fall_back_to_imdb', False):
+                print('The movie "' + movie['title'] + '" don\'t have a content rating on tmdb for this country.')
+                content_rating = ':-???-:'
+
+        if content_rating is None:
             if movie['imdb_id'] is None:
-                return
-            elif len(movie['imdb_id']) != 9:
-                return
-
-        content_rating = get_imdb_content_rating(movie, settings['content_rating_country_code'])
-
-        found = False
-        for to_rating, rename_from_list in config.items('RATINGS'):
-
-            while ', ' in rename_from_list:
-                rename_from_list = rename_from_list.replace(', ', ',')
-            while ' ,' in rename_from_list:
-                rename_from_list = rename_from_list.replace(' ,', ',')
+                get_tmdb_movie_metadata(movie)
+                if movie['imdb_id'] is None:
+                    return
+                elif len(movie['imdb_id']) != 9:
+                    return
 
-            rename_from_list = rename_from_list.split(',')
+            content_rating = get_imdb_content_rating(movie, settings['content_rating_country_code'])
 
-            for from_rating in rename_from_list:
-                if from_rating.lower() == content_rating.lower():
-                    content_rating = to_rating
-                    found = True
-        if not found:
-            content_rating = '???'
+        content_rating = rating_renames.get(content_rating.lower(), '???')
 
         movie['metadata_items_jobs']['content_rating'] = content_rating
         if settings.getboolean('lock_after_completion') and '8' not in movie['user_fields']:
@@ -516,20 +726,11 @@ def process_movie(movie):
             if movie['tagline'] != '':
                 return
 
-        if settings.getboolean('prefer_secondary_language'):
-            check_secondary_language_metadata()
-            if secondary_tmdb_movie_metadata['tagline'] != '':
-                tagline = secondary_tmdb_movie_metadata['tagline']
-            else:
-                check_main_language_metadata()
-                tagline = tmdb_movie_metadata['tagline']
-        else:
-            check_main_language_metadata()
-            if tmdb_movie_metadata['tagline'] != '':
-                tagline = tmdb_movie_metadata['tagline']
-            else:
-                check_secondary_language_metadata()
-                tagline = secondary_tmdb_movie_metadata['tagline']
+        tagline = ''
+        for language in get_tmdb_languages(settings):
+            tagline = get_tmdb_movie_metadata(movie, language)['tagline']
+            if tagline != '':
+                break
 
         if not tagline == '':
             movie['metadata_items_jobs']['tagline'] = tagline
@@ -542,61 +743,38 @@ def process_movie(movie):
                 if any("15" == s for s in movie['user_fields']):
                     return
 
-        tags_list = dict()
-        for tags_info in cursor.execute("SELECT id, tag "
-                                        "FROM tags "
-                                        "WHERE tag_type = 1 "):
-            tags_list[tags_info[1].lower()] = tags_info[0]
-        movie['tags_list'] = tags_list
-
-        taggings_list = dict()
-        for tag_id in tags_list:
-            cursor.execute("SELECT id, tag_id "
-                           "FROM taggings "
-                           "WHERE metadata_item_id = " + str(movie['metadata_id']) + " "
-                           "AND tag_id = " + str(tags_list[tag_id]))
-            tag = cursor.fetchone()
-            if tag is None:
-                continue
-            taggings_list[tag[0]] = tag[1]
-        movie['taggings_list'] = taggings_list
-
-        for rename_to, rename_from_list in config.items('GENRES'):
-            while ', ' in rename_from_list:
-                rename_from_list = rename_from_list.replace(', ', ',')
-            while ' ,' in rename_from_list:
-                rename_from_list = rename_from_list.replace(' ,', ',')
+        if genre_tags is None:
+            load_genre_index()
+        movie['tags_list'] = genre_tags
+        movie['taggings_list'] = genre_taggings.get(movie['metadata_id'], dict())
 
-            rename_from_list = rename_from_list.split(',')
+        for rename_to, rename_from_list in genre_renames:
             new_tag_id = None
             for rename_from in rename_from_list:
-                for tagging_id in movie['taggings_list']:
+                if rename_from not in movie['tags_list']:
+                    continue
 
-                    if rename_from.lower() == rename_to.lower():
-                        continue
-
-                    if rename_from.lower() not in movie['tags_list']:
-                        continue
+                for tagging_id in movie['taggings_list']:
 
-                    elif (rename_to.lower() not in movie['tags_list']) and (new_tag_id is None):
+                    if (rename_to not in movie['tags_list']) and (new_tag_id is None):
 
                         add_to_commit_list(tags_commits,
-                                           movie['tags_list'][rename_from.lower()],
+                                           movie['tags_list'][rename_from],
                                            'tag',
                                            rename_to.title())
                         new_tag_id = movie['tags_list'][rename_from]
 
-                    elif (rename_to.lower() not in movie['tags_list']) and (new_tag_id is not None):
+                    elif (rename_to not in movie['tags_list']) and (new_tag_id is not None):
                         add_to_commit_list(taggings_commits,
                                            tagging_id,
                                            'tag_id',
                                            new_tag_id)
 
-                    elif movie['taggings_list'][tagging_id] == movie['tags_list'][rename_from.lower()]:
+                    elif movie['taggings_list'][tagging_id] == movie['tags_list'][rename_from]:
                         add_to_commit_list(taggings_commits,
                                            tagging_id,
                                            'tag_id',
-                                           movie['tags_list'][rename_to.lower()])
+                                           movie['tags_list'][rename_to])
 
         if settings.getboolean('lock_after_completion') and '15' not in movie['user_fields']:
             movie['user_fields'].append('15')
@@ -610,6 +788,7 @@ def process_movie(movie):
             change_original_titles()
     except ValueError as e:
         print(e)
+        movie['failed'] = True
 
     # change movie content rating.
     try:
@@ -618,6 +797,7 @@ def process_movie(movie):
             change_content_ratings()
     except ValueError as e:
         print(e)
+        movie['failed'] = True
 
     # add missing tagline.
     try:
@@ -626,6 +806,7 @@ def process_movie(movie):
             add_missing_tagline()
     except ValueError as e:
         print(e)
+        movie['failed'] = True
 
     # convert genres.
     settings = config['GENRES_SETTINGS']
@@ -633,53 +814,457 @@ def process_movie(movie):
         convert_genres()
 
 
-def process_collection(collection):
+def load_library_snapshot():
+    # Reads the movies and the collection memberships of the library in bulk,
+    # so the movie loop doesn't need to query the database once per movie.
+    global library_movies
+    global collection_members
 
-    def mass_symlink_creation(source_folder, target_folder, id_tag):
-        if not os.path.isdir(target_folder):
-            os.makedirs(target_folder, mode=0o777, exist_ok=True)
-        for file in os.listdir(source_folder):
-            source_file = os.path.join(source_folder, file)
-            if len(file) > 35:
-                target_file = os.path.join(target_folder, id_tag + file[-35:])
-            else:
-                target_file = os.path.join(target_folder, id_tag + file)
-            if not os.path.exists(target_file):
-                try:
-                    os.symlink(source_file, target_file)
-                except OSError as broken_symlink:
-                    if broken_symlink.errno == errno.EEXIST:
-                        os.remove(target_file)
-                        os.symlink(source_file, target_file)
+    library_movies = dict()
+    cursor.execute('SELECT id, guid, title, original_title, tagline, content_rating, user_fields, hash, updated_at '
+                   'FROM metadata_items '
+                   'WHERE library_section_id = ? '
+                   'AND metadata_type = 1', (library_key,))
+    for movie_info in cursor.fetchall():
+        library_movies[movie_info[0]] = movie_info
 
-    def download_image(image_source, image_type, source_name):
+    collection_members = dict()
+    cursor.execute('SELECT taggings.tag_id, taggings.metadata_item_id '
+                   'FROM tags '
+                   'INNER JOIN taggings '
+                   'ON tags.tag_type = 2 '
+                   'AND tags.id = taggings.tag_id')
+    for tag_id, metadata_item_id in cursor.fetchall():
+        collection_members.setdefault(tag_id, list()).append(metadata_item_id)
 
-        target = os.path.join(plex_home_dir, 'Metadata', 'Collections', collection['hash'][0],
-                              collection['hash'][1:] + '.bundle', 'Uploads', image_type,
-                              'g' + image_source[1:])
+    load_collection_index()
 
-        picture_url = 'https://image.tmdb.org/t/p/original' + image_source
 
-        download_dir = os.path.split(target)[0]
+def load_collection_index():
+    # The title column isn't indexed, so every collection is read once and looked up by title in memory.
+    global library_collections
 
-        if (not os.path.isfile(target)) or settings.getboolean('force'):
+    library_collections = dict()
+    cursor.execute('SELECT id, content_rating, user_fields, [index], hash, summary, title '
+                   'FROM metadata_items '
+                   'WHERE metadata_type = 18 '
+                   'AND library_section_id = ?', (library_key,))
+    for collection_info in cursor.fetchall():
+        add_to_collection_index(collection_info)
+
+
+def get_collection_title_key(title):
+    return trim_suffix(title).casefold()
+
+
+def add_to_collection_index(collection_info):
+    # collection_info: (id, content_rating, user_fields, [index], hash, summary, title)
+
+    library_collections.setdefault(get_collection_title_key(collection_info[6]), list()).append(collection_info)
+
+
+def get_collections_by_title(title):
+    return library_collections.get(get_collection_title_key(title), list())
+
+
+def trim_suffix(title):
+    # Walks the title backwards through the suffix trie. If several suffixes match, the one listed first is trimmed.
+
+    node = collection_suffix_trie
+    found_suffix = None  # example: (place in the list, length)
+    for character in reversed(title.lower()):
+        node = node.get(character)
+        if node is None:
+            break
+        if None in node and (found_suffix is None or node[None][0] < found_suffix[0]):
+            found_suffix = node[None]
+    if found_suffix is not None:
+        title = title[:-(found_suffix[1] + 1)]
+    return title
+
+
+def split_rule_list(rule_list):
+    # 'action  ,   action-movie, act' -> ['action', 'action-movie', 'act']
+    return re.split(' *, *', rule_list)
+
+
+def load_rule_tables():
+    # Reads the [RATINGS] and [GENRES] tables and the collection suffixes once, in to lookup tables,
+    # so the movies don't have to parse and scan them again.
+    global rating_names
+    global rating_name_set
+    global rating_renames
+    global genre_renames
+    global collection_suffix_trie
+
+    rating_rules = list()
+    if config.has_section('RATINGS'):
+        for to_rating, rename_from_list in config.items('RATINGS'):
+            rating_rules.append((to_rating, [from_rating.lower() for from_rating in split_rule_list(rename_from_list)]))
+    rating_names = tuple(to_rating for to_rating, rename_from_list in rating_rules)
+    rating_name_set = frozenset(rating_names)
+
+    # a renamed rating may be renamed again further down the table, so each one is run through all of it.
+    rating_renames = dict()
+    for to_rating, rename_from_list in rating_rules:
+        for from_rating in rename_from_list:
+            content_rating = from_rating
+            for rule_to_rating, rule_from_list in rating_rules:
+                for rule_from_rating in rule_from_list:
+                    if rule_from_rating == content_rating.lower():
+                        content_rating = rule_to_rating
+            rating_renames[from_rating] = content_rating
+
+    genre_rules = list()
+    if config.has_section('GENRES'):
+        for rename_to, rename_from_list in config.items('GENRES'):
+            genre_rules.append((rename_to.lower(),
+                                tuple(rename_from.lower() for rename_from in split_rule_list(rename_from_list)
+                                      if rename_from.lower() != rename_to.lower())))
+    genre_renames = tuple(genre_rules)
+
+    collection_suffix_trie = dict()
+    suffixes = config.get('COLLECTIONS_SETTINGS', 'collection_suffixes_to_remove', fallback='')
+    for index, suffix in enumerate(suffixes.replace(' ', '').split(',')):
+        if suffix == '':
+            continue
+        node = collection_suffix_trie
+        for character in reversed(suffix.lower()):
+            node = node.setdefault(character, dict())
+        node.setdefault(None, (index, len(suffix)))
+
+
+def create_collections(new_collections):
+    # new_collections: [('Star Wars', first movie metadata id, tmdb collection id), ...]
+    # Creates the collections through the plex api, each with its first movie. The movies are fetched by rating key
+    # and the new collections are read back from the database with one query. A collection that plex fails to
+    # create is skipped, the movie loop will report it as not found.
+
+    if len(new_collections) == 0:
+        return
+
+    print('Creating ' + str(len(new_collections)) + ' new collections.')
+    rating_keys = [str(metadata_id) for title, metadata_id, collection_id in new_collections]
+    plex_movies = dict()
+    try:
+        for plex_movie in plex_server.fetchItems('/library/metadata/' + ','.join(rating_keys)):
+            plex_movies[int(plex_movie.ratingKey)] = plex_movie
+    except (PlexApiException, RequestException) as e:
+        print('Unable to fetch the movies of the new collections from plex: ' + str(e) + '. Skipping')
+        return
+
+    created_titles = list()
+    for title, metadata_id, collection_id in new_collections:
+        try:
+            plex_movies[metadata_id].addCollection(title)
+        except KeyError:
+            print('Unable to create collection "' + title + '", plex didn\'t return its movie. Skipping')
+            continue
+        except (PlexApiException, RequestException) as e:
+            print('Unable to create collection "' + title + '": ' + str(e) + '. Skipping')
+            continue
+        register_collection(collection_id)['created_with'] = metadata_id
+        created_titles.append(title)
+    database.commit()
+
+    if len(created_titles) == 0:
+        return
+    cursor.execute('SELECT id, content_rating, user_fields, [index], hash, summary, title '
+                   'FROM metadata_items '
+                   'WHERE metadata_type = 18 '
+                   'AND library_section_id = ? '
+                   'AND title IN (' + ', '.join('?' * len(created_titles)) + ')', [library_key] + created_titles)
+    for collection_info in cursor.fetchall():
+        add_to_collection_index(collection_info)
+
+
+def get_collection_members(tag_id):
+    # Collections that weren't in the snapshot (new or empty ones) are looked up in the database.
+
+    if tag_id not in collection_members:
+        cursor.execute('SELECT taggings.metadata_item_id '
+                       'FROM tags '
+                       'INNER JOIN taggings '
+                       'ON tags.tag_type = 2 '
+                       'AND tags.id = taggings.tag_id '
+                       'AND tags.id = ?', (tag_id,))
+        collection_members[tag_id] = [movie_id[0] for movie_id in cursor.fetchall()]
+    return collection_members[tag_id]
+
+
+def get_config_fingerprint():
+    # Changing any rule should make incremental mode look at every movie again.
+    sections = [section for section in config.sections()
+                if section not in ('GLOBAL_SETTINGS', 'NETWORK', 'CACHE', 'TOOLS')]
+    fingerprint = [main_language, secondary_language] + fallback_languages
+    for section in sections:
+        fingerprint.append([section, sorted(config.items(section))])
+    return hashlib.sha1(json.dumps(fingerprint).encode('utf-8')).hexdigest()
+
+
+def load_run_state():
+    global run_state
+
+    run_state = {'config_fingerprint': get_config_fingerprint(), 'movies': dict()}
+    if not os.path.isfile(state_file):
+        return
+    try:
+        with codecs.open(state_file, 'r', 'utf-8') as open_state_file:
+            saved_state = json.load(open_state_file)
+    except ValueError:
+        print('The state file is unreadable, processing every movie.')
+        return
+    if saved_state.get('config_fingerprint') != run_state['config_fingerprint']:
+        print('The config has changed since the last run, processing every movie.')
+        return
+    run_state['movies'] = saved_state.get('movies', dict())
 
-            if not os.path.isdir(download_dir):
-                os.makedirs(download_dir, mode=0o777, exist_ok=True)
 
-            with open(target, 'wb') as download_file:
+def has_movie_changed(movie_id):
 
-                response = retrieve_web_page(picture_url, source_name)
+    movie_info = library_movies[movie_id]
+    seen = run_state['movies'].get(str(movie_id))
+    if seen is None:
+        return True
+    return seen['updated_at'] != movie_info[8] or seen['hash'] != movie_info[7] or seen['guid'] != movie_info[1]
 
-                download_file.write(response.read())
 
-    def check_main_language_metadata():
-        if tmdb_collection_metadata is None:
-            get_tmdb_collection_metadata(collection)
+def save_run_state(timestamp):
+    # Movies edited in this run get the timestamp they were written with, so they don't count as changed next time.
 
-    def check_secondary_language_metadata():
-        if secondary_tmdb_collection_metadata is None:
-            get_secondary_tmdb_collection_metadata(collection)
+    if run_state is None:
+        load_run_state()
+
+    for movie_id in processed_movie_ids:
+        movie_info = library_movies.get(movie_id)
+        if movie_info is None:
+            continue
+        decisions = dict(metadata_items_commits.get(movie_id, dict()))
+        decisions.pop('refreshed_at', None)
+        decisions.pop('updated_at', None)
+        updated_at = movie_info[8]
+        if len(decisions) > 0:
+            updated_at = timestamp
+        run_state['movies'][str(movie_id)] = {'updated_at': updated_at,
+                                              'hash': movie_info[7],
+                                              'guid': movie_info[1],
+                                              'decisions': decisions}
+
+    state_dir = os.path.split(state_file)[0]
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir, mode=0o777, exist_ok=True)
+    with codecs.open(state_file + '.tmp', 'w', 'utf-8') as open_state_file:
+        json.dump(run_state, open_state_file)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def save_journal(last_movie_id):
+    # Saves the planned changes and how far the run got, so an interrupted run can be resumed.
+
+    journal = {'config_fingerprint': get_config_fingerprint(),
+               'last_movie_id': last_movie_id,
+               'processed_movie_ids': processed_movie_ids,
+               'metadata_items_commits': metadata_items_commits,
+               'taggings_commits': taggings_commits,
+               'tags_commits': tags_commits,
+               'taggings_insert_commits': taggings_insert_commits,
+               'delete_commits': delete_commits,
+               'image_download_queue': image_download_queue,
+               'symlink_queue': symlink_queue,
+               'planned_collections': planned_collections}
+
+    journal_dir = os.path.split(journal_file)[0]
+    if not os.path.isdir(journal_dir):
+        os.makedirs(journal_dir, mode=0o777, exist_ok=True)
+    with codecs.open(journal_file + '.tmp', 'w', 'utf-8') as open_journal_file:
+        json.dump(journal, open_journal_file)
+    os.replace(journal_file + '.tmp', journal_file)
+
+
+def load_journal(movie_ids):
+    # Restores the planned changes of an interrupted run.
+    # returns: the position in movie_ids to continue from.
+
+    if not global_settings.getboolean('resume_interrupted_runs', True) or not os.path.isfile(journal_file):
+        return 0
+    try:
+        with codecs.open(journal_file, 'r', 'utf-8') as open_journal_file:
+            journal = json.load(open_journal_file)
+    except ValueError:
+        print('The journal of the last run is unreadable, starting over.')
+        return 0
+    if journal.get('config_fingerprint') != get_config_fingerprint():
+        print('The config has changed since the interrupted run, starting over.')
+        return 0
+
+    commit_lists = {'metadata_items_commits': metadata_items_commits,
+                    'taggings_commits': taggings_commits,
+                    'tags_commits': tags_commits,
+                    'taggings_insert_commits': taggings_insert_commits}
+    for name, commit_list in commit_lists.items():
+        for entry_id, d in journal[name].items():
+            commit_list[int(entry_id)] = d
+    delete_commits.extend(journal['delete_commits'])
+    for target, queued_image in journal.get('image_download_queue', dict()).items():
+        image_download_queue[target] = tuple(queued_image)
+    symlink_queue.extend(journal.get('symlink_queue', list()))
+    planned_collections.extend(journal.get('planned_collections', list()))
+    processed_movie_ids.extend(movie_id for movie_id in journal['processed_movie_ids'] if movie_id in library_movies)
+
+    if journal['last_movie_id'] is None:
+        return 0
+    if journal['last_movie_id'] not in movie_ids:
+        print('Resuming an interrupted run, but the last processed movie is gone. Starting from the beginning.')
+        return 0
+    start_index = movie_ids.index(journal['last_movie_id']) + 1
+    print('Resuming an interrupted run after ' + str(start_index) + ' of ' + str(len(movie_ids)) + ' movies.')
+    return start_index
+
+
+def remove_journal():
+    if os.path.isfile(journal_file):
+        os.remove(journal_file)
+
+
+def load_genre_index():
+    # Loads every genre tag and the genre taggings of all the movies in the library in two queries.
+    global genre_tags
+    global genre_taggings
+
+    genre_tags = dict()
+    for tags_info in cursor.execute('SELECT id, tag '
+                                    'FROM tags '
+                                    'WHERE tag_type = 1 '
+                                    'ORDER BY id'):
+        genre_tags[tags_info[1].lower()] = tags_info[0]
+    genre_tag_ids = set(genre_tags.values())
+
+    genre_taggings = dict()
+    cursor.execute('SELECT taggings.metadata_item_id, taggings.id, taggings.tag_id '
+                   'FROM taggings '
+                   'INNER JOIN tags '
+                   'ON tags.id = taggings.tag_id '
+                   'AND tags.tag_type = 1 '
+                   'INNER JOIN metadata_items '
+                   'ON metadata_items.id = taggings.metadata_item_id '
+                   'AND metadata_items.library_section_id = ? '
+                   'AND metadata_items.metadata_type = 1 '
+                   'ORDER BY taggings.metadata_item_id, tags.id, taggings.id', (library_key,))
+    for metadata_item_id, tagging_id, tag_id in cursor.fetchall():
+        if tag_id not in genre_tag_ids:
+            continue
+        movie_taggings = genre_taggings.setdefault(metadata_item_id, dict())
+        if tag_id not in movie_taggings.values():
+            movie_taggings[tagging_id] = tag_id
+
+
+def load_offline_content_ratings():
+    # Loads the content rating file, if one is used, into a lookup by imdb id and tmdb id.
+    # Only the ratings for the configured country are kept.
+    global offline_content_ratings
+
+    settings = config['CONTENT_RATING_SETTINGS']
+    content_rating_source = settings.get('content_rating_source', 'imdb')
+    if content_rating_source in ('imdb', 'tmdb'):
+        return
+    elif content_rating_source != 'file':
+        raise ValueError('"' + content_rating_source + '" is not a valid content_rating_source. '
+                         'Use imdb, tmdb or file.')
+    content_rating_file = settings.get('content_rating_file')
+    if content_rating_file is None or not os.path.isfile(content_rating_file):
+        raise ValueError('The content rating file "' + str(content_rating_file) + '" does not exist.')
+
+    country = settings['content_rating_country_code'].upper()
+    offline_content_ratings = dict()
+    file_type = os.path.splitext(content_rating_file)[1].lower()
+    with codecs.open(content_rating_file, 'r', 'utf-8') as open_content_rating_file:
+        if file_type in ('.json', '.jsonl', '.ndjson'):
+            # TMDB release_dates responses, one per line. "imdb_id" is used as well if it's in there.
+            for line in open_content_rating_file:
+                if line.strip() == '':
+                    continue
+                release_dates = json.loads(line)
+                for release_country in release_dates.get('results', list()):
+                    if release_country.get('iso_3166_1', '').upper() != country:
+                        continue
+                    for release_date in release_country.get('release_dates', list()):
+                        if release_date.get('certification', '') != '':
+                            for movie_id in (release_dates.get('imdb_id'), release_dates.get('id')):
+                                if movie_id is not None and str(movie_id) not in offline_content_ratings:
+                                    offline_content_ratings[str(movie_id)] = release_date['certification']
+                            break
+        else:
+            # <imdb id or tmdb id>, <country code>, <certification>. tab separated if it's a .tsv file.
+            for row in csv.reader(open_content_rating_file, delimiter='\t' if file_type == '.tsv' else ','):
+                if len(row) < 3 or row[1].strip().upper() != country or row[2].strip() == '':
+                    continue
+                if row[0].strip() not in offline_content_ratings:
+                    offline_content_ratings[row[0].strip()] = row[2].strip()
+
+    print('Loaded ' + str(len(offline_content_ratings)) + ' content ratings for ' + country +
+          ' from "' + content_rating_file + '".')
+
+
+def get_offline_content_rating(movie):
+    # returns: the content rating from the content rating file, or None if it's not in there.
+
+    if offline_content_ratings is None:
+        return None
+    for movie_id in (movie['imdb_id'], movie['tmdb_id']):
+        if movie_id is not None and str(movie_id) in offline_content_ratings:
+            return offline_content_ratings[str(movie_id)]
+    return None
+
+
+def create_symlinks(source_folder, target_folder, id_tag):
+    # Symlinks every image of a movie into the collection folder.
+
+    if not os.path.isdir(target_folder):
+        os.makedirs(target_folder, mode=0o777, exist_ok=True)
+    for file in os.listdir(source_folder):
+        source_file = os.path.join(source_folder, file)
+        if len(file) > 35:
+            target_file = os.path.join(target_folder, id_tag + file[-35:])
+        else:
+            target_file = os.path.join(target_folder, id_tag + file)
+        if not os.path.exists(target_file):
+            try:
+                os.symlink(source_file, target_file)
+            except OSError as broken_symlink:
+                if broken_symlink.errno == errno.EEXIST:
+                    os.remove(target_file)
+                    os.symlink(source_file, target_file)
+
+
+def process_collection(collection):
+
+    def mass_symlink_creation(source_folder, target_folder, id_tag):
+        if arguments.plan_out is not None:
+            if [source_folder, target_folder, id_tag] not in symlink_queue:
+                symlink_queue.append([source_folder, target_folder, id_tag])
+            return
+        create_symlinks(source_folder, target_folder, id_tag)
+
+    def download_image(image_source, image_type, image_size, source_name, commit_column=None, commit_lock=None):
+        # commit_column and commit_lock are dropped from the commit if the image fails to download.
+
+        target = os.path.join(plex_home_dir, 'Metadata', 'Collections', collection['hash'][0],
+                              collection['hash'][1:] + '.bundle', 'Uploads', image_type,
+                              'g' + image_source[1:])
+
+        picture_url = 'https://image.tmdb.org/t/p/' + image_size + image_source
+
+        downloaded_images = register_collection(collection['collection_id'])['downloaded_images']
+        if target in downloaded_images:
+            return
+        downloaded_images.add(target)
+
+        if commit_lock in collection['user_fields']:
+            commit_lock = None
+
+        if (not os.path.isfile(target)) or settings.getboolean('force'):
+            image_download_queue[target] = (picture_url, source_name, collection['metadata_id'],
+                                            commit_column, commit_lock)
 
     def update_content_rating():
 
@@ -689,7 +1274,7 @@ def process_collection(collection):
                     return
 
         found = False
-        for content_rating in config.items('RATINGS'):
+        for content_rating in rating_names:
             if content_rating == collection['content_rating']:
 
                 break
@@ -716,26 +1301,12 @@ def process_collection(collection):
                 if collection['summary'] != '':
                     return
         found = False
-        if settings.getboolean('prefer_secondary_language'):
-            check_secondary_language_metadata()
-            if secondary_tmdb_collection_metadata['overview'] != '':
-                collection['metadata_items_jobs']['summary'] = secondary_tmdb_collection_metadata['overview']
-                found = True
-            else:
-                check_main_language_metadata()
-                if tmdb_collection_metadata['overview'] != '':
-                    collection['metadata_items_jobs']['summary'] = tmdb_collection_metadata['overview']
-                    found = True
-        else:
-            check_main_language_metadata()
-            if tmdb_collection_metadata['overview'] != '':
-                collection['metadata_items_jobs']['summary'] = tmdb_collection_metadata['overview']
+        for language in get_tmdb_languages(settings):
+            overview = get_tmdb_collection_metadata(collection, language)['overview']
+            if overview != '':
+                collection['metadata_items_jobs']['summary'] = overview
                 found = True
-            else:
-                check_secondary_language_metadata()
-                if secondary_tmdb_collection_metadata['overview'] != '':
-                    collection['metadata_items_jobs']['summary'] = secondary_tmdb_collection_metadata['overview']
-                    found = True
+                break
 
         if found:
             if settings.getboolean('lock_after_completion') and '7' not in collection['user_fields']:
@@ -757,16 +1328,14 @@ def process_collection(collection):
                 if '9' in collection['user_fields']:
                     return
 
-        if tmdb_collection_metadata is not None:
-            current_metadata_holder = tmdb_collection_metadata
-        elif secondary_tmdb_collection_metadata is not None:
-            current_metadata_holder = secondary_tmdb_collection_metadata
-        else:
-            check_main_language_metadata()
-            current_metadata_holder = tmdb_collection_metadata
+        current_metadata_holder = get_any_tmdb_collection_metadata(collection)
+
+        poster_size = get_image_size(settings, 'poster_size', poster_sizes)
+        movies_poster_size = get_image_size(settings, 'movies_poster_size', poster_sizes)
 
         if current_metadata_holder['poster_path'] is not None:
-            download_image(current_metadata_holder['poster_path'], 'posters', 'poster for collection')
+            download_image(current_metadata_holder['poster_path'], 'posters', poster_size, 'poster for collection',
+                           'user_thumb_url', '9')
 
             collection['metadata_items_jobs']['user_thumb_url'] = 'upload://posters/g' \
                                                                   + current_metadata_holder['poster_path'][1:]
@@ -774,7 +1343,7 @@ def process_collection(collection):
         if settings.getboolean('add_movies_posters'):
             for movie in current_metadata_holder['parts']:
                 if movie['poster_path'] is not None:
-                    download_image(movie['poster_path'], 'poster', 'poster for collection')
+                    download_image(movie['poster_path'], 'posters', movies_poster_size, 'poster from movies')
 
         if settings.getboolean('lock_after_completion') and '9' not in collection['user_fields']:
             collection['user_fields'].append('9')
@@ -795,16 +1364,14 @@ def process_collection(collection):
                 if '10' in collection['user_fields']:
                     return
 
-        if tmdb_collection_metadata is not None:
-            current_metadata_holder = tmdb_collection_metadata
-        elif secondary_tmdb_collection_metadata is not None:
-            current_metadata_holder = secondary_tmdb_collection_metadata
-        else:
-            check_main_language_metadata()
-            current_metadata_holder = tmdb_collection_metadata
+        current_metadata_holder = get_any_tmdb_collection_metadata(collection)
+
+        art_size = get_image_size(settings, 'art_size', backdrop_sizes)
+        movies_art_size = get_image_size(settings, 'movies_art_size', backdrop_sizes)
 
         if current_metadata_holder['backdrop_path'] is not None:
-            download_image(current_metadata_holder['backdrop_path'], 'art', 'art for collection')
+            download_image(current_metadata_holder['backdrop_path'], 'art', art_size, 'art for collection',
+                           'user_art_url', '10')
 
             collection['metadata_items_jobs']['user_art_url'] = 'upload://art/g' \
                                                                 + current_metadata_holder['backdrop_path'][1:]
@@ -812,7 +1379,7 @@ def process_collection(collection):
         if settings.getboolean('add_movies_art'):
             for movie in current_metadata_holder['parts']:
                 if movie['backdrop_path'] is not None:
-                    download_image(current_metadata_holder['backdrop_path'], 'art', 'art from movies')
+                    download_image(movie['backdrop_path'], 'art', movies_art_size, 'art from movies')
 
         if settings.getboolean('lock_after_completion') and '10' not in collection['user_fields']:
             collection['user_fields'].append('10')
@@ -854,7 +1421,20 @@ def process_collection(collection):
 
 def commit_to_database():
 
-    if global_settings.getboolean('prompt_before_committing', True):
+    online_writes = global_settings.getboolean('online_writes', False)
+    if global_settings.getboolean('prompt_before_committing', True) and online_writes:
+        print('-----------------------------------------------------------')
+        print('The script is now ready to write to your database.')
+        print('It will be written in small parts while Plex keeps running.')
+        print('-----------------------------------------------------------')
+        cont = input("Do you wish to proceed? yes/no > ")
+        while cont.lower() not in ("yes", "no"):
+            cont = input("Do you wish to proceed? yes/no > ")
+        if cont == "no":
+            print('Exiting.')
+            database.close()
+            return False
+    elif global_settings.getboolean('prompt_before_committing', True):
         print('-----------------------------------------------------------')
         print('The script is now ready to write to your database.')
         print('Please turn off Plex media server until the script is done.')
@@ -866,7 +1446,7 @@ def commit_to_database():
         if cont == "no":
             print('Exiting.')
             database.close()
-            return
+            return False
         if plex_api_installed:
             try:
                 PlexServer(plex_server_ip_address, plex_auth_token)
@@ -879,7 +1459,7 @@ def commit_to_database():
                 if cont == "no":
                     print('Exiting.')
                     database.close()
-                    return
+                    return False
 
             except ConnectionError:
                 pass
@@ -899,193 +1479,1341 @@ def commit_to_database():
     for item in taggings_insert_commits:
         taggings_insert_commits[item]['created_at'] = timestamp
 
+    try:
+        if online_writes:
+            write_batches_online(build_write_batches(by_change=True))
+        else:
+            write_batches(build_write_batches())
+    except sqlite3.Error as e:
+        if online_writes:
+            print('Failed to write to the database, only the parts written before this were changed: ' + str(e))
+        else:
+            print('Failed to write to the database, nothing was changed: ' + str(e))
+        database.close()
+        return False
+
+    if global_settings.getboolean('incremental_mode', False):
+        save_run_state(timestamp)
+
+    database.close()
+    print('-----------------------------------------------------------')
+    print('The writing process is now over.')
+    if online_writes:
+        print('Plex was left running the whole time, there is nothing more to do.')
+    else:
+        print('you may turn on your Plex server now.')
+    return True
+
+
+def build_write_batches(by_change=False):
+    # Groups the pending changes into statements that share table and columns.
+    # returns: [(sql statement, [parameters for each row]), ...] in the order they should be executed.
+    # by_change: group them by what belongs together in stead, so that a change is never split between two
+    # transactions. A collection delete is three statements, a genre rename is the tag and the taggings moved to it.
+    # returns: [[(sql statement, parameters), ...], ...]
+
+    batches = dict()
+    changes = dict()
+
+    def add_row(change, sql, parameters):
+        batches.setdefault(sql, list()).append(parameters)
+        changes.setdefault(change, list()).append((sql, parameters))
+
+    def add_update(change, table, entry_id, columns_changes):
+        columns = tuple(columns_changes)
+        sql = 'UPDATE ' + table + ' SET ' + ', '.join(column + ' = ?' for column in columns) + ' WHERE id = ?'
+        add_row(change, sql, tuple(columns_changes[column] for column in columns) + (entry_id,))
+
+    def add_insert(change, table, entry):
+        columns = tuple(entry)
+        sql = 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ') ' \
+              'VALUES (' + ', '.join('?' * len(columns)) + ')'
+        add_row(change, sql, tuple(entry[column] for column in columns))
+
     for metadata_id, d in metadata_items_commits.items():
         if len(d) <= 2:
             continue
-        command = 'UPDATE metadata_items SET'
-        for column, value in d.items():
-            command += ' ' + str(column) + ' = "' + str(value).replace('"', '') + '",'
-        command = command[:-1]
-        command += ' WHERE id = ' + str(metadata_id)
-        cursor.execute(command)
+        add_update(('metadata_items', metadata_id), 'metadata_items', metadata_id, d)
 
     for tagging_id, d in taggings_commits.items():
         if len(d) == 0:
             continue
-        command = 'UPDATE taggings SET'
-        for column, value in d.items():
-            command += ' ' + str(column) + ' = "' + str(value).replace('"', '') + '",'
-        command = command[:-1]
-        command += ' WHERE id = ' + str(tagging_id)
-        cursor.execute(command)
+        if len(tags_commits.get(d.get('tag_id'), dict())) > 1:
+            # moved to a tag that is renamed as well.
+            add_update(('tags', d['tag_id']), 'taggings', tagging_id, d)
+        else:
+            add_update(('taggings', tagging_id), 'taggings', tagging_id, d)
 
     for tag_id, d in tags_commits.items():
         if len(d) <= 1:
             continue
-        command = 'UPDATE tags SET'
-        for column, value in d.items():
-            command += ' ' + str(column) + ' = "' + str(value).replace('"', '') + '",'
-        command = command[:-1]
-        command += ' WHERE id = ' + str(tag_id)
-        cursor.execute(command)
+        add_update(('tags', tag_id), 'tags', tag_id, d)
 
     for tag_id, d in taggings_insert_commits.items():
         if len(d) <= 1:
             continue
-        command = 'INSERT INTO taggings '
-        command_column_names = '('
-        command_values = '('
-        for column, value in d.items():
-            command_column_names += column + ', '
-            command_values += '"' + str(value) + '", '
-
-        command_column_names = command_column_names[:-2] + ') '
-        command_values = command_values[:-2] + ') '
-        command += command_column_names + 'VALUES ' + command_values
-        cursor.execute(command)
+        add_insert(('insert', tag_id), 'taggings', d)
 
     for item in delete_commits:
-        cursor.execute('UPDATE metadata_items SET metadata_type = "10000" WHERE id = ?', (item[0],))
-        cursor.execute('DELETE FROM tags WHERE id = ?', (item[1],))
-        cursor.execute('DELETE FROM taggings WHERE tag_id = ? AND metadata_item_id = ?', (item[1], item[0],))
+        add_row(('delete', item[0]), 'UPDATE metadata_items SET metadata_type = 10000 WHERE id = ?', (item[0],))
+        add_row(('delete', item[0]), 'DELETE FROM tags WHERE id = ?', (item[1],))
+        add_row(('delete', item[0]), 'DELETE FROM taggings WHERE tag_id = ? AND metadata_item_id = ?',
+                (item[1], item[0],))
+
+    if by_change:
+        return list(changes.values())
+    return list(batches.items())
 
+
+def write_batches(batches):
+    # Writes all batches in one transaction, either everything is written or nothing is.
+
+    rows = sum(len(parameters) for sql, parameters in batches)
+    start_time = time.time()
+    if database.in_transaction:
+        database.commit()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        for sql, parameters in batches:
+            cursor.executemany(sql, parameters)
+    except sqlite3.Error:
+        database.rollback()
+        raise
     database.commit()
+    elapsed_time = max(time.time() - start_time, 0.000001)
+
+    print('Wrote ' + str(rows) + ' rows in ' + str(len(batches)) + ' batches in ' +
+          str(round(elapsed_time, 3)) + ' seconds (' + str(int(rows / elapsed_time)) + ' rows/second).')
+
+
+def write_batches_online(changes):
+    # Writes the changes in small transactions so Plex is never locked out of the database for long.
+    # Each change is written whole, a change bigger than online_batch_size gets a transaction of its own.
+    # A transaction that finds the database busy is rolled back and tried again a little later.
+
+    if cursor.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+        print('The database is not in WAL mode, Plex can\'t read from it while a part is being written.')
+
+    transaction_size = max(global_settings.getint('online_batch_size', 200), 1)
+    transactions = list()
+    transaction_rows = transaction_size
+    for change in changes:
+        if transaction_rows + len(change) > transaction_size:
+            transactions.append(dict())
+            transaction_rows = 0
+        for sql, parameters in change:
+            transactions[-1].setdefault(sql, list()).append(parameters)
+        transaction_rows += len(change)
+
+    rows = sum(len(change) for change in changes)
+    lock_times = list()
+    busy_retries = 0
+    start_time = time.time()
+    if database.in_transaction:
+        database.commit()
+    for transaction in transactions:
+        if len(transaction) == 0:
+            continue
+        for attempt in range(10):
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+                locked_at = time.time()
+                for sql, parameters in transaction.items():
+                    cursor.executemany(sql, parameters)
+                database.commit()
+                lock_times.append(time.time() - locked_at)
+                break
+            except sqlite3.OperationalError as e:
+                if database.in_transaction:
+                    database.rollback()
+                if 'locked' not in str(e) and 'busy' not in str(e) or attempt == 9:
+                    raise
+                busy_retries += 1
+                time.sleep(min(0.05 * 2 ** attempt, 2) * random.uniform(0.5, 1))
+            except sqlite3.Error:
+                if database.in_transaction:
+                    database.rollback()
+                raise
+    elapsed_time = max(time.time() - start_time, 0.000001)
+
+    print('Wrote ' + str(rows) + ' rows in ' + str(len(lock_times)) + ' transactions in ' +
+          str(round(elapsed_time, 3)) + ' seconds (' + str(int(rows / elapsed_time)) + ' rows/second).')
+    if len(lock_times) > 0:
+        print('The database was locked for ' + str(round(max(lock_times) * 1000, 1)) + ' ms at most, ' +
+              str(round(sum(lock_times) / len(lock_times) * 1000, 1)) + ' ms on average. Waited for Plex ' +
+              str(busy_retries) + ' times.')
+
+
+def build_plan():
+    # Lists the pending changes with the values they replace.
+    # returns: [{'table': ..., 'action': 'update', 'id': ..., 'before': {...}, 'after': {...}}, ...]
+
+    def get_current_values(table, entry_id, columns):
+        cursor.execute('SELECT ' + ', '.join(columns) + ' FROM ' + table + ' WHERE id = ?', (entry_id,))
+        fetch = cursor.fetchone()
+        if fetch is None:
+            return None
+        return dict(zip(columns, fetch))
+
+    plan = list()
+    for table, commit_list in (('metadata_items', metadata_items_commits),
+                               ('taggings', taggings_commits),
+                               ('tags', tags_commits)):
+        for entry_id, changes in commit_list.items():
+            changes = {column: value for column, value in changes.items()
+                       if column not in ('inherited_data', 'refreshed_at', 'updated_at')}
+            if len(changes) == 0:
+                continue
+            plan.append({'table': table, 'action': 'update', 'id': entry_id,
+                         'before': get_current_values(table, entry_id, list(changes)), 'after': changes})
+
+    for entry in taggings_insert_commits.values():
+        entry = {column: value for column, value in entry.items() if column != 'created_at'}
+        if len(entry) == 0:
+            continue
+        plan.append({'table': 'taggings', 'action': 'insert', 'after': entry})
+
+    for metadata_item_id, tag_id in delete_commits:
+        plan.append({'table': 'metadata_items', 'action': 'delete', 'id': metadata_item_id, 'tag_id': tag_id,
+                     'before': get_current_values('metadata_items', metadata_item_id, ['title', 'metadata_type'])})
+
+    return plan
+
+
+def save_plan(plan_file):
+    # Saves the planned changes to a .json file, or one change per line to a .ndjson file.
+
+    plan_header = {'created_at': datetime.now().replace(microsecond=0).isoformat(' '),
+                   'config_fingerprint': get_config_fingerprint(),
+                   'processed_movie_ids': processed_movie_ids,
+                   'collections_to_create': planned_collections,
+                   'images_to_download': image_download_queue,
+                   'symlinks_to_create': symlink_queue}
+    plan = build_plan()
+
+    plan_dir = os.path.split(os.path.abspath(plan_file))[0]
+    if not os.path.isdir(plan_dir):
+        os.makedirs(plan_dir, mode=0o777, exist_ok=True)
+    with codecs.open(plan_file + '.tmp', 'w', 'utf-8') as open_plan_file:
+        if os.path.splitext(plan_file)[1].lower() in ('.ndjson', '.jsonl'):
+            open_plan_file.write(json.dumps(plan_header, ensure_ascii=False) + '\n')
+            for change in plan:
+                open_plan_file.write(json.dumps(change, ensure_ascii=False) + '\n')
+        else:
+            plan_header['changes'] = plan
+            json.dump(plan_header, open_plan_file, ensure_ascii=False, indent=1)
+    os.replace(plan_file + '.tmp', plan_file)
     database.close()
+
     print('-----------------------------------------------------------')
-    print('The writing process is now over.')
-    print('you may turn on your Plex server now.')
+    print('Saved ' + str(len(plan)) + ' planned changes to "' + plan_file + '". Nothing was written to the database.')
+    if len(planned_collections) + len(image_download_queue) + len(symlink_queue) > 0:
+        print('When applied, the plan also creates ' + str(len(planned_collections)) + ' collections, downloads ' +
+              str(len(image_download_queue)) + ' images and symlinks the images of ' + str(len(symlink_queue)) +
+              ' movies.')
+    print('Write them with: --apply "' + plan_file + '"')
+    print('-----------------------------------------------------------')
+    return True
+
+
+def apply_plan(plan_file):
+    # Writes a plan saved with --plan-out. Rows that have changed since the plan was made are left alone.
+
+    with codecs.open(plan_file, 'r', 'utf-8') as open_plan_file:
+        if os.path.splitext(plan_file)[1].lower() in ('.ndjson', '.jsonl'):
+            plan_header = json.loads(open_plan_file.readline())
+            plan = [json.loads(line) for line in open_plan_file if line.strip() != '']
+        else:
+            plan_header = json.load(open_plan_file)
+            plan = plan_header['changes']
+    if plan_header.get('config_fingerprint') != get_config_fingerprint():
+        print('The config has changed since the plan was made, the plan is applied as it is anyway.')
+
+    backup_database(database_dir, database_backup_dir)
+    load_library_snapshot()
+    processed_movie_ids.extend(movie_id for movie_id in plan_header.get('processed_movie_ids', list())
+                               if movie_id in library_movies)
+
+    commit_lists = {'metadata_items': metadata_items_commits, 'taggings': taggings_commits, 'tags': tags_commits}
+    changed_since_plan = 0
+    for change in plan:
+        if change['action'] == 'insert':
+            cursor.execute('SELECT id FROM taggings WHERE metadata_item_id = ? AND tag_id = ?',
+                           (change['after']['metadata_item_id'], change['after']['tag_id'],))
+            if cursor.fetchone() is None:
+                taggings_insert_commits[change['after']['metadata_item_id']] = dict(change['after'])
+            else:
+                changed_since_plan += 1
+            continue
+
+        columns = list(change['before'] or change['after'] or dict())
+        cursor.execute('SELECT ' + ', '.join(columns) + ' FROM ' + change['table'] + ' WHERE id = ?', (change['id'],))
+        fetch = cursor.fetchone()
+        if change['before'] is None or fetch is None or dict(zip(columns, fetch)) != change['before']:
+            changed_since_plan += 1
+            continue
 
+        if change['action'] == 'delete':
+            delete_commits.append([change['id'], change['tag_id']])
+        else:
+            commit_lists[change['table']][change['id']] = dict(change['after'])
+
+    if changed_since_plan > 0:
+        print(str(changed_since_plan) + ' planned changes were skipped, their rows have changed since the plan was made.')
+    print('Applying ' + str(len(plan) - changed_since_plan) + ' planned changes from "' + plan_file + '".')
+
+    new_collections = [tuple(new_collection) for new_collection in plan_header.get('collections_to_create', list())
+                       if len(get_collections_by_title(new_collection[0])) == 0
+                       and new_collection[1] in library_movies]
+    if len(new_collections) > 0:
+        if plex_api_installed:
+            create_collections(new_collections)
+            print('Run the script again to fill in the new collections.')
+        else:
+            print('Unable to create ' + str(len(new_collections)) +
+                  ' new collections because Plex api is unavailable. Skipping')
+    for target, queued_image in plan_header.get('images_to_download', dict()).items():
+        image_download_queue[target] = tuple(queued_image)
+    download_queued_images()
+    for source_folder, target_folder, id_tag in plan_header.get('symlinks_to_create', list()):
+        create_symlinks(source_folder, target_folder, id_tag)
+
+    commit_to_database()
 
-def retrieve_web_page(url, page_name='page'):
 
+def retrieve_web_page(url, page_name='page', stream=False, headers=None):
+
+    if connection_lost_event.is_set():
+        raise ConnectionLostError('Lost internet connection.')
+
+    host = urlsplit(url).hostname
     response = None
     print('Downloading ' + page_name + '.')
     for attempt in range(20):
+        acquire_rate_limit(host)
         try:
-            response = urlopen(url, timeout=2)
-            break
-        except timeout:
-            print('Failed to download ' + page_name + ' : timed out. Trying again in 2 seconds.')
-            time.sleep(2)
+            response = get_http_session().get(url, timeout=2, stream=stream, headers=headers)
+        except Timeout:
+            delay = retry_delay(host, attempt)
+            print('Failed to download ' + page_name + ' : timed out. Trying again in ' + str(delay) + ' seconds.')
+            time.sleep(delay)
             if attempt > 8:
-                print('You might have lost internet connection.')
-                print('Breaking out of loop and committing')
-                commit_to_database()
-                sys.exit()
-        except HTTPError as e:
-            raise ValueError('Failed to download ' + page_name + ' : ' + e.msg + '. Skipping.')
-        except URLError:
-            print('Failed to download ' + page_name + '. Trying again in 2 seconds')
-            time.sleep(2)
+                connection_lost()
+            continue
+        except RequestException:
+            delay = retry_delay(host, attempt)
+            print('Failed to download ' + page_name + '. Trying again in ' + str(delay) + ' seconds')
+            time.sleep(delay)
             if attempt > 8:
-                print('You might have lost internet connection.')
-                print('Breaking out of loop and committing')
-                commit_to_database()
-                sys.exit()
-    rate_limit_check(response.headers)
+                connection_lost()
+            continue
+        if response.status_code == 429:
+            update_rate_limit(host, response.headers, throttled=True)
+            response.close()
+            response = None
+            print('Rate limit hit while downloading ' + page_name + '. Trying again.')
+            continue
+        if response.status_code >= 400:
+            response.close()
+            raise ValueError('Failed to download ' + page_name + ' : ' + str(response.reason) + '. Skipping.')
+        break
+    if response is None:
+        raise ValueError('Failed to download ' + page_name + ' : too manny attempts. Skipping.')
+    update_rate_limit(host, response.headers)
     return response
 
-def rate_limit_check(header):
+
+def get_http_session():
+    # All downloads share one session, so connections to each host are kept alive and reused.
+    global http_session
+
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10,
+                                  pool_maxsize=max(network_settings.getint('max_connections_per_host', 8), 1),
+                                  pool_block=True,
+                                  max_retries=0)
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+            if network_settings.getboolean('use_compression', True):
+                http_session.headers['Accept-Encoding'] = 'gzip, deflate'
+            else:
+                http_session.headers['Accept-Encoding'] = 'identity'
+    return http_session
+
+
+class ConnectionLostError(Exception):
+    pass
+
+
+def connection_lost():
+    print('You might have lost internet connection.')
+    connection_lost_event.set()
+    raise ConnectionLostError('Lost internet connection.')
+
+
+def download_queued_images():
+    # Downloads the queued images in parallel, each image only once. Images are streamed to a temporary file
+    # which is moved in place when complete, so Plex never sees a half written image.
+    # With the image store enabled every image is stored once by its content hash and hard linked into the bundles.
+
+    def download_queued_image(picture_url, source_name, target, known_etag, stored_image):
+        # returns: (path of the complete image or None, etag, downloaded bytes)
+        if stored_image is not None:
+            return stored_image, None, 0
+
+        headers = None
+        if not use_image_store and known_etag is not None and os.path.isfile(target):
+            headers = {'If-None-Match': known_etag}
+        try:
+            response = retrieve_web_page(picture_url, source_name, stream=True, headers=headers)
+        except (ValueError, ConnectionLostError) as e:
+            print(e)
+            return None, None, 0
+        if use_image_store:
+            download_file_path = os.path.join(image_store_dir,
+                                              hashlib.sha1(picture_url.encode('utf-8')).hexdigest() + '.part')
+        else:
+            download_file_path = target + '.part'
+        try:
+            if headers is not None and response.status_code == 304:
+                return target, known_etag, 0
+            etag = response.headers.get('ETag')
+
+            download_dir = os.path.split(download_file_path)[0]
+            if not os.path.isdir(download_dir):
+                os.makedirs(download_dir, mode=0o777, exist_ok=True)
+            content_hash = hashlib.sha256()
+            downloaded_bytes = 0
+            with open(download_file_path, 'wb') as download_file:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    download_file.write(chunk)
+                    content_hash.update(chunk)
+                    downloaded_bytes += len(chunk)
+
+            if use_image_store:
+                image_path = get_stored_image_path(content_hash.hexdigest())
+                if not os.path.isdir(os.path.split(image_path)[0]):
+                    os.makedirs(os.path.split(image_path)[0], mode=0o777, exist_ok=True)
+            else:
+                image_path = target
+            os.replace(download_file_path, image_path)
+            return image_path, etag, downloaded_bytes
+        except (OSError, RequestException) as e:
+            print('Failed to download ' + source_name + ' : ' + str(e) + '. Skipping.')
+            if os.path.isfile(download_file_path):
+                os.remove(download_file_path)
+            return None, None, 0
+        finally:
+            response.close()
+
+    if len(image_download_queue) == 0:
+        return
+
+    queued_images = dict(image_download_queue)
+    image_download_queue.clear()
+    use_image_store = (cache_settings.getboolean('enable_cache', False) and
+                       cache_settings.getboolean('image_store', False))
+
+    targets_by_url = dict()
+    for target, queued_image in queued_images.items():
+        targets_by_url.setdefault(queued_image[0], list()).append(target)
+    downloads = list()
+    for picture_url, targets in targets_by_url.items():
+        stored_image = None
+        if use_image_store:
+            stored_image = get_stored_image(picture_url)
+        downloads.append((picture_url, queued_images[targets[0]][1], targets[0],
+                          get_image_etag(targets[0]), stored_image))
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(global_settings.getint('download_threads', 8), 1)) as executor:
+        results = list(executor.map(lambda download: download_queued_image(*download), downloads))
+    elapsed_time = max(time.time() - start_time, 0.000001)
+
+    total_bytes = 0
+    downloaded = 0
+    for download, (image_path, etag, downloaded_bytes) in zip(downloads, results):
+        picture_url = download[0]
+        for target in targets_by_url[picture_url]:
+            if image_path is not None and image_path != target:
+                try:
+                    link_image(image_path, target)
+                except OSError as e:
+                    print('Failed to add image "' + target + '" : ' + str(e) + '. Skipping.')
+            if not os.path.isfile(target):
+                drop_image_commit(*queued_images[target][2:])
+
+        if image_path is not None and use_image_store:
+            save_stored_image(picture_url, image_path)
+        elif etag is not None:
+            save_image_etag(download[2], etag)
+        total_bytes += downloaded_bytes
+        downloaded += downloaded_bytes > 0
+
+    print('Downloaded ' + str(downloaded) + ' of ' + str(len(downloads)) + ' images for ' +
+          str(len(queued_images)) + ' targets, ' +
+          str(round(total_bytes / 1024 / 1024, 1)) + ' MB in ' + str(round(elapsed_time, 1)) + ' seconds (' +
+          str(round(total_bytes / 1024 / 1024 / elapsed_time, 1)) + ' MB/second).')
+
+
+def link_image(source, target):
+    # Hard links the image into place, or copies it if the two folders are on different file systems.
+
+    if os.path.isfile(target) and os.path.samefile(source, target):
+        return
+    target_dir = os.path.split(target)[0]
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir, mode=0o777, exist_ok=True)
+    if os.path.lexists(target + '.part'):
+        os.remove(target + '.part')
     try:
-        limit = int(header['x-ratelimit-remaining'])
-    except:
-        limit = 40
-    if limit < 1:
-        print('Rate limit with TMDB API hit. Will pause for 10 seconds')
-        time.sleep(10)
+        os.link(source, target + '.part')
+    except OSError:
+        copyfile(source, target + '.part')
+    os.replace(target + '.part', target)
+
+
+def get_stored_image_path(content_hash):
+    return os.path.join(image_store_dir, content_hash[:2], content_hash)
+
+
+def get_image_size(settings, option, valid_sizes):
+    size = settings.get(option, 'original')
+    if size not in valid_sizes:
+        raise ValueError('"' + size + '" is not a valid ' + option + '. Use one of: ' + ', '.join(valid_sizes))
+    return size
+
+
+def drop_image_commit(metadata_id, commit_column, commit_lock):
+    # Don't point Plex to an image that failed to download, and leave the field unlocked so it's tried again.
+
+    if commit_column is None or metadata_id not in metadata_items_commits:
+        return
+    jobs = metadata_items_commits[metadata_id]
+    jobs.pop(commit_column, None)
+    if 'user_fields' in jobs and commit_lock is not None:
+        user_fields = [value for value in jobs['user_fields'].split('=')[1].split('|') if value != commit_lock]
+        jobs['user_fields'] = 'lockedFields=' + '|'.join(user_fields)
+
+
+def retrieve_web_data(url, page_name='page'):
+
+    if url in prefetched_pages:
+        return prefetched_pages[url]
+
+    response = retrieve_web_page(url, page_name)
+    data = response.content
+    response.close()
+    if keep_retrieved_pages:
+        prefetched_pages[url] = data
+    return data
+
+
+def prefetch_web_page(url, page_name='page'):
+
+    if url in prefetched_pages:
+        return prefetched_pages[url]
+
+    try:
+        response = retrieve_web_page(url, page_name)
+        data = response.content
+        response.close()
+    except (ValueError, ConnectionLostError) as e:
+        print(e)
+        return None
+    prefetched_pages[url] = data
+    return data
+
+
+def map_in_threads(function, items, max_workers):
+    # Like executor.map, but a Ctrl-C cancels the downloads that haven't started in stead of waiting for them all.
+    # returns: the results in the order of items.
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(function, item) for item in items]
+        results = [future.result() for future in futures]
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return results
+
+
+def prefetch_web_pages(movie_ids):
+    # Downloads the pages the movie loop will ask for, concurrently and ahead of time.
+    # The movie loop itself is unchanged, it just finds its pages in prefetched_pages.
+
+    def prefetch_all(pages):
+        # pages: [(url, page_name, tmdb cache key or None), ...]
+        missing_pages = list()
+        for url, page_name, cache_key in pages:
+            if url in prefetched_pages:
+                continue
+            if cache_key is not None:
+                data = get_cached_tmdb_data(*cache_key)
+                if data is not None:
+                    prefetched_pages[url] = data
+                    continue
+            missing_pages.append((url, page_name))
+        if len(missing_pages) == 0:
+            return
+        map_in_threads(lambda page: prefetch_web_page(*page), missing_pages, download_threads)
+
+    def tmdb_page(endpoint, item_id, language, page_name):
+        return tmdb_url(endpoint, item_id, language), page_name, (endpoint, item_id, language)
+
+    def is_wanted(settings, lock=None, filled_in=False):
+        # filled_in: the field already has a value the category leaves alone unless forced.
+        if not settings.getboolean('enable_category', False):
+            return False
+        if settings.getboolean('force', False):
+            return True
+        if filled_in:
+            return False
+        if lock is None or not settings.getboolean('respect_lock', True):
+            return True
+        return lock not in movie['user_fields']
+
+    def load_prefetched_json(url):
+        if prefetched_pages.get(url) is None:
+            return None
+        try:
+            return json.loads(prefetched_pages[url].decode('utf-8'))
+        except ValueError:
+            return None
+
+    download_threads = global_settings.getint('download_threads', 8)
+    if download_threads < 2 or len(movie_ids) == 0:
+        return
+
+    title_settings = config['ORIGINAL_TITLE_SETTINGS']
+    rating_settings = config['CONTENT_RATING_SETTINGS']
+    tagline_settings = config['TAGLINE_SETTINGS']
+    collection_settings = config['COLLECTIONS_SETTINGS']
+
+    movies = list()
+    for movie_id in movie_ids:
+        movie_info = library_movies.get(movie_id)
+        if movie_info is None:
+            continue
+        movie = {'guid': movie_info[1], 'tmdb_id': None, 'imdb_id': None, 'user_fields': list()}
+        if movie_info[6] != '':
+            movie['user_fields'] = movie_info[6].split('=')[1].split('|')
+        if ".themoviedb" in movie['guid']:
+            movie['tmdb_id'] = movie['guid'].split('//')[1].split('?')[0]
+            movie['imdb_id'] = imdb_id_map.get(movie['tmdb_id'])
+        elif ".imdb" in movie['guid']:
+            movie['imdb_id'] = movie['guid'].split('//')[1].split('?')[0]
+            movie['tmdb_id'] = movie_id_map.get(movie['imdb_id'])
+        else:
+            continue
+        # content_rating: the movie needs its certificates from imdb.
+        # the same checks the categories make before they look anything up.
+        content_rating = movie_info[5] or ''
+        has_content_rating = content_rating in rating_name_set \
+            or content_rating.lower() == rating_settings.get('unknown_content_rating', '').lower()
+        movie['content_rating'] = is_wanted(rating_settings, '8', has_content_rating)
+        movie['tmdb_content_rating'] = movie['content_rating'] \
+            and rating_settings.get('content_rating_source', 'imdb') == 'tmdb'
+        if movie['content_rating'] and rating_settings.get('content_rating_source', 'imdb') == 'file':
+            movie['content_rating'] = rating_settings.getboolean('fall_back_to_imdb', False) \
+                and get_offline_content_rating(movie) is None
+        elif movie['tmdb_content_rating']:
+            movie['content_rating'] = rating_settings.getboolean('fall_back_to_imdb', False)
+        # languages: the movie metadata the movie loop will ask for first. Fallback languages are left to the loop.
+        movie['languages'] = list()
+        for category_settings, lock, filled_in in ((title_settings, '3', False),
+                                                   (tagline_settings, '6', movie_info[4] != ''),
+                                                   (collection_settings, None, False)):
+            category_language = get_tmdb_languages(category_settings)[0]
+            if is_wanted(category_settings, lock, filled_in) and category_language not in movie['languages']:
+                movie['languages'].append(category_language)
+        if (movie['content_rating'] and movie['imdb_id'] is None or movie['tmdb_content_rating']) \
+                and main_language not in movie['languages']:
+            movie['languages'].append(main_language)
+        if 'translations' in tmdb_appends['movie'] and len(movie['languages']) > 0:
+            # the other languages are in the translations of the main language metadata.
+            movie['languages'] = [main_language]
+        movies.append(movie)
+
+    # First pass, tmdb ids for movies that only have an imdb id and aren't in the movie id map.
+    prefetch_all([(tmdb_url('find', movie['imdb_id'], 'en-US'), 'tmdb id', None) for movie in movies
+                  if movie['tmdb_id'] is None and len(movie['imdb_id']) == 9
+                  and movie['imdb_id'] not in movie_id_map
+                  and len(movie['languages']) > 0])
+    found_movie_ids = list()
+    for movie in movies:
+        if movie['tmdb_id'] is None and len(movie['imdb_id']) == 9 and movie['imdb_id'] not in movie_id_map:
+            data = load_prefetched_json(tmdb_url('find', movie['imdb_id'], 'en-US'))
+            if data is not None:
+                movie['tmdb_id'] = get_tmdb_id_from_find_results(data)
+                found_movie_ids.append((movie['imdb_id'], movie['tmdb_id']))
+    remember_movie_ids(found_movie_ids)
+
+    # Second pass, the movie metadata.
+    pages = list()
+    for movie in movies:
+        if movie['tmdb_id'] is None:
+            continue
+        for language in movie['languages']:
+            pages.append(tmdb_page('movie', movie['tmdb_id'], language, language + ' movie metadata from tmdb'))
+    prefetch_all(pages)
+
+    # Third pass, collection metadata and imdb certificates.
+    pages = list()
+    missing_imdb_ids = list()
+    collection_language = get_tmdb_languages(collection_settings)[0]
+    if 'translations' in tmdb_appends['movie']:
+        movie_language = main_language
+    else:
+        movie_language = collection_language
+    if 'translations' in tmdb_appends['collection']:
+        collection_language = main_language
+    for movie in movies:
+        movie_metadata = None
+        if movie['tmdb_id'] is not None:
+            movie_metadata = load_prefetched_json(tmdb_url('movie', movie['tmdb_id'], movie_language))
+            for language in tmdb_languages:
+                any_movie_metadata = load_prefetched_json(tmdb_url('movie', movie['tmdb_id'], language))
+                if movie['imdb_id'] is None and any_movie_metadata is not None:
+                    movie['imdb_id'] = any_movie_metadata['imdb_id']
+                    remember_movie_ids([(movie['imdb_id'], movie['tmdb_id'])])
+            if movie['tmdb_content_rating']:
+                any_movie_metadata = load_prefetched_json(tmdb_url('movie', movie['tmdb_id'], main_language))
+                if any_movie_metadata is not None and get_tmdb_content_rating(
+                        any_movie_metadata, rating_settings['content_rating_country_code']) is not None:
+                    movie['content_rating'] = False
+
+        if movie_metadata is not None and movie_metadata.get('belongs_to_collection') is not None \
+                and collection_settings.getboolean('enable_category', False):
+            pages.append(tmdb_page('collection', str(movie_metadata['belongs_to_collection']['id']),
+                                   collection_language, 'collection metadata from tmdb'))
+
+        if movie['content_rating'] and movie['imdb_id'] is not None and len(movie['imdb_id']) == 9 \
+                and movie['imdb_id'] not in imdb_certificates:
+            data = get_cached_tmdb_data('certificates', movie['imdb_id'], '')
+            if data is not None:
+                imdb_certificates[movie['imdb_id']] = json.loads(data.decode('utf-8'))
+            elif movie['imdb_id'] not in missing_imdb_ids:
+                missing_imdb_ids.append(movie['imdb_id'])
+    prefetch_all(pages)
+
+    downloaded_certificates = map_in_threads(prefetch_imdb_certificates, missing_imdb_ids, download_threads)
+    for imdb_id, certificates in zip(missing_imdb_ids, downloaded_certificates):
+        if certificates is not None:
+            imdb_certificates[imdb_id] = certificates
+            cache_tmdb_data('certificates', imdb_id, '', json.dumps(certificates).encode('utf-8'))
+
+
+def get_rate_limit_bucket(host):
+    # One token bucket per host, shared by all download threads. Call with rate_limit_lock held.
+
+    if host not in rate_limit_buckets:
+        if host == 'api.themoviedb.org':
+            rate = network_settings.getfloat('tmdb_api_requests_per_second', 40)
+        elif host == 'image.tmdb.org':
+            rate = network_settings.getfloat('tmdb_image_requests_per_second', 20)
+        elif host is not None and host.endswith('imdb.com'):
+            rate = network_settings.getfloat('imdb_requests_per_second', 5)
+        else:
+            rate = network_settings.getfloat('other_requests_per_second', 10)
+        rate = max(rate, 0.1)
+        rate_limit_buckets[host] = {'rate': rate,
+                                    'capacity': max(rate, 1),
+                                    'tokens': max(rate, 1),
+                                    'refilled_at': time.time(),
+                                    'blocked_until': 0,
+                                    'requests': 0,
+                                    'waited': 0.0,
+                                    'throttled': 0,
+                                    'retries': 0}
+    return rate_limit_buckets[host]
+
+
+def acquire_rate_limit(host):
+    # Waits until the host's bucket has a token to spend on a request.
+
+    while True:
+        with rate_limit_lock:
+            bucket = get_rate_limit_bucket(host)
+            now = time.time()
+            bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['refilled_at']) * bucket['rate'])
+            bucket['refilled_at'] = now
+            if bucket['blocked_until'] > now:
+                wait = bucket['blocked_until'] - now
+            elif bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                bucket['requests'] += 1
+                return
+            else:
+                wait = (1 - bucket['tokens']) / bucket['rate']
+            bucket['waited'] += wait
+        time.sleep(wait)
+
+
+def update_rate_limit(host, headers, throttled=False):
+    # Lets the rate limit headers of a response correct the host's bucket.
+
+    with rate_limit_lock:
+        bucket = get_rate_limit_bucket(host)
+        now = time.time()
+        if throttled:
+            bucket['throttled'] += 1
+            bucket['tokens'] = 0
+            bucket['blocked_until'] = max(bucket['blocked_until'], now + 1)
+
+        try:
+            remaining = int(headers.get('x-ratelimit-remaining'))
+        except (TypeError, ValueError):
+            remaining = None
+        if remaining is not None:
+            bucket['tokens'] = min(bucket['tokens'], remaining)
+            if remaining < 1:
+                try:
+                    reset = float(headers.get('x-ratelimit-reset'))
+                except (TypeError, ValueError):
+                    reset = now + 1
+                bucket['blocked_until'] = max(bucket['blocked_until'], min(reset, now + 60))
+
+        try:
+            retry_after = float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            retry_after = None
+        if retry_after is not None:
+            bucket['blocked_until'] = max(bucket['blocked_until'], now + min(retry_after, 60))
+
+
+def retry_delay(host, attempt):
+    # Exponential backoff with full jitter.
+
+    with rate_limit_lock:
+        get_rate_limit_bucket(host)['retries'] += 1
+    delay = min(network_settings.getfloat('max_retry_delay', 30), 0.5 * 2 ** attempt)
+    return round(random.uniform(delay / 2, delay), 1)
+
+
+def get_rate_limit_stats():
+    with rate_limit_lock:
+        return {host: {key: bucket[key] for key in ('requests', 'waited', 'throttled', 'retries')}
+                for host, bucket in rate_limit_buckets.items()}
+
+
+def print_rate_limit_stats():
+    for host, stats in get_rate_limit_stats().items():
+        print(host + ': ' + str(stats['requests']) + ' requests, ' + str(round(stats['waited'], 1)) +
+              ' seconds spent waiting on the rate limit in total, ' + str(stats['throttled']) + ' times throttled, ' +
+              str(stats['retries']) + ' retries.')
+
+
+def tmdb_url(endpoint, item_id, language):
+    url = 'https://api.themoviedb.org/3/' + endpoint + '/' + str(item_id) + \
+          '?api_key=' + tmdb_api_key + \
+          '&language=' + language
+    if endpoint == 'find':
+        url += '&external_source=imdb_id'
+    elif len(tmdb_appends.get(endpoint, list())) > 0:
+        url += '&append_to_response=' + ','.join(tmdb_appends[endpoint])
+    return url
+
+
+def tmdb_cache_language(endpoint, language):
+    # Metadata is cached separately for each set of appended data.
+
+    if len(tmdb_appends.get(endpoint, list())) > 0:
+        return language + '+' + ','.join(tmdb_appends[endpoint])
+    return language
+
+
+def retrieve_tmdb_data(endpoint, item_id, language, page_name='page'):
+
+    data = get_cached_tmdb_data(endpoint, item_id, language)
+    if data is None:
+        data = retrieve_web_data(tmdb_url(endpoint, item_id, language), page_name)
+        cache_tmdb_data(endpoint, item_id, language, data)
+    return data
+
+
+def open_cache():
+    global cache_database
+
+    if cache_database is None:
+        cache_dir = os.path.split(cache_file)[0]
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, mode=0o777, exist_ok=True)
+        cache_database = sqlite3.connect(cache_file)
+        cache_database.execute('PRAGMA journal_mode = WAL')
+        cache_database.execute('PRAGMA synchronous = NORMAL')
+        cache_database.execute('CREATE TABLE IF NOT EXISTS movie_ids ('
+                               'imdb_id TEXT PRIMARY KEY, '
+                               'tmdb_id TEXT, '
+                               'resolved_at REAL NOT NULL)')
+        cache_database.execute('CREATE TABLE IF NOT EXISTS image_store ('
+                               'url TEXT PRIMARY KEY, '
+                               'content_hash TEXT NOT NULL)')
+        cache_database.execute('CREATE TABLE IF NOT EXISTS image_etags ('
+                               'path TEXT PRIMARY KEY, '
+                               'etag TEXT NOT NULL)')
+        cache_database.execute('CREATE TABLE IF NOT EXISTS tmdb_cache ('
+                               'endpoint TEXT NOT NULL, '
+                               'item_id TEXT NOT NULL, '
+                               'language TEXT NOT NULL, '
+                               'fetched_at REAL NOT NULL, '
+                               'last_used REAL NOT NULL, '
+                               'data BLOB NOT NULL, '
+                               'PRIMARY KEY (endpoint, item_id, language))')
+    return cache_database
+
+
+def get_cached_tmdb_data(endpoint, item_id, language):
+
+    if not cache_settings.getboolean('enable_cache', False):
+        return None
+
+    language = tmdb_cache_language(endpoint, language)
+    cache = open_cache()
+    now = time.time()
+    fetch = cache.execute('SELECT fetched_at, data '
+                          'FROM tmdb_cache '
+                          'WHERE endpoint = ? '
+                          'AND item_id = ? '
+                          'AND language = ?', (endpoint, str(item_id), language,)).fetchone()
+    if fetch is None:
+        return None
+    if now - fetch[0] > cache_settings.getfloat(endpoint + '_ttl_days', 30) * 86400:
+        return None
+
+    cache.execute('UPDATE tmdb_cache SET last_used = ? '
+                  'WHERE endpoint = ? '
+                  'AND item_id = ? '
+                  'AND language = ?', (now, endpoint, str(item_id), language,))
+    cache.commit()
+    return fetch[1]
+
+
+def cache_tmdb_data(endpoint, item_id, language, data):
+
+    if not cache_settings.getboolean('enable_cache', False):
+        return
+
+    language = tmdb_cache_language(endpoint, language)
+    cache = open_cache()
+    now = time.time()
+    cache.execute('INSERT OR REPLACE INTO tmdb_cache (endpoint, item_id, language, fetched_at, last_used, data) '
+                  'VALUES (?, ?, ?, ?, ?, ?)', (endpoint, str(item_id), language, now, now, data,))
+    cache.commit()
+
+
+def get_image_etag(path):
+
+    if not cache_settings.getboolean('enable_cache', False):
+        return None
+
+    fetch = open_cache().execute('SELECT etag '
+                                 'FROM image_etags '
+                                 'WHERE path = ?', (path,)).fetchone()
+    if fetch is None:
+        return None
+    return fetch[0]
+
+
+def save_image_etag(path, etag):
+
+    if not cache_settings.getboolean('enable_cache', False):
+        return
+
+    cache = open_cache()
+    cache.execute('INSERT OR REPLACE INTO image_etags (path, etag) '
+                  'VALUES (?, ?)', (path, etag,))
+    cache.commit()
+
+
+def get_stored_image(url):
+    # returns: the path of the image in the image store, if it's there.
+
+    fetch = open_cache().execute('SELECT content_hash '
+                                 'FROM image_store '
+                                 'WHERE url = ?', (url,)).fetchone()
+    if fetch is None or not os.path.isfile(get_stored_image_path(fetch[0])):
+        return None
+    return get_stored_image_path(fetch[0])
+
+
+def save_stored_image(url, image_path):
+
+    cache = open_cache()
+    cache.execute('INSERT OR REPLACE INTO image_store (url, content_hash) '
+                  'VALUES (?, ?)', (url, os.path.split(image_path)[1],))
+    cache.commit()
+
+
+def trim_cache():
+    # Drops expired entries, then the least recently used ones until the cache fits in max_cache_size_mb.
+
+    if cache_database is None:
+        return
+
+    now = time.time()
+    for endpoint in ('find', 'movie', 'collection', 'certificates'):
+        cache_database.execute('DELETE FROM tmdb_cache '
+                               'WHERE endpoint = ? '
+                               'AND fetched_at < ?',
+                               (endpoint, now - cache_settings.getfloat(endpoint + '_ttl_days', 30) * 86400,))
+
+    cache_database.execute('DELETE FROM tmdb_cache '
+                           'WHERE rowid IN ('
+                           'SELECT rowid FROM ('
+                           'SELECT rowid, SUM(LENGTH(data)) OVER (ORDER BY last_used DESC, rowid) AS used_size '
+                           'FROM tmdb_cache) '
+                           'WHERE used_size > ?)',
+                           (int(cache_settings.getfloat('max_cache_size_mb', 200) * 1024 * 1024),))
+    cache_database.commit()
+
+
+def imdb_parental_guide_url(imdb_id):
+    return "https://www.imdb.com/title/" + imdb_id + "/parentalguide?ref_=tt_ql_stry_5"
+
 
 def get_tmdb_movie_id(movie):
     if len(movie['imdb_id']) != 9:
         movie['no_id'] = True
         raise ValueError("Movie have no ID.")
 
-    response = retrieve_web_page('https://api.themoviedb.org/3/find/'
-                                 + movie['imdb_id'] +
-                                 '?api_key=' + tmdb_api_key +
-                                 '&language=en-US'
-                                 '&external_source=imdb_id', 'tmdb id')
-
-    data = json.loads(response.read().decode('utf-8'))
+    if movie['imdb_id'] not in movie_id_map:
+        data = retrieve_web_data(tmdb_url('find', movie['imdb_id'], 'en-US'), 'tmdb id')
+        remember_movie_ids([(movie['imdb_id'], get_tmdb_id_from_find_results(json.loads(data.decode('utf-8'))))])
 
-    if len(data['movie_results']) == 0:
+    if movie_id_map[movie['imdb_id']] is None:
         movie['no_tmdb_id'] = True
         raise ValueError('Unable to find TMDB ID. Skipping.')
 
-    movie['tmdb_id'] = str(data['movie_results'][0]['id'])
-    response.close()
+    movie['tmdb_id'] = movie_id_map[movie['imdb_id']]
 
 
-def get_tmdb_movie_metadata(movie):
-    global tmdb_movie_metadata
+def get_tmdb_id_from_find_results(data):
 
-    if movie['tmdb_id'] is None:
-        get_tmdb_movie_id(movie)
+    if len(data['movie_results']) == 0:
+        return None
+    return str(data['movie_results'][0]['id'])
 
-    response = retrieve_web_page('https://api.themoviedb.org/3/movie/'
-                                 + movie['tmdb_id'] +
-                                 '?api_key=' + tmdb_api_key +
-                                 '&language=' + main_language, 'Main language movie metadata from tmdb')
 
-    tmdb_movie_metadata = json.loads(response.read().decode('utf-8'))
-    if movie['imdb_id'] is None:
-        movie['imdb_id'] = tmdb_movie_metadata['imdb_id']
-    response.close()
+def load_movie_id_map():
+    # Loads the imdb id <-> tmdb id map from the cache. Found ids are kept for good, so tmdb is only asked once
+    # per movie. That tmdb had no match is only trusted for find_ttl_days.
+
+    if cache_settings.getboolean('enable_cache', False):
+        expired = time.time() - cache_settings.getfloat('find_ttl_days', 90) * 86400
+        for imdb_id, tmdb_id, resolved_at in open_cache().execute('SELECT imdb_id, tmdb_id, resolved_at '
+                                                                  'FROM movie_ids'):
+            if tmdb_id is None and resolved_at < expired:
+                continue
+            movie_id_map[imdb_id] = tmdb_id
+            if tmdb_id is not None:
+                imdb_id_map[tmdb_id] = imdb_id
+
+
+def look_up_missing_movie_ids():
+    # Looks up the tmdb id of every imdb movie in the library that's missing from the movie id map, concurrently.
+    # The ids are saved a chunk at a time, so a stopped run keeps what it found. Without the cache the map can't be
+    # kept, so the movies are left to be looked up one batch at a time as they're processed.
+
+    if not cache_settings.getboolean('enable_cache', False):
+        return
+    if not any(config[section].getboolean('enable_category', False) for section in
+               ('ORIGINAL_TITLE_SETTINGS', 'TAGLINE_SETTINGS', 'COLLECTIONS_SETTINGS')):
+        return
+
+    missing_imdb_ids = set()
+    for movie_info in library_movies.values():
+        if ".imdb" in movie_info[1]:
+            imdb_id = movie_info[1].split('//')[1].split('?')[0]
+            if len(imdb_id) == 9 and imdb_id not in movie_id_map:
+                missing_imdb_ids.add(imdb_id)
+    if len(missing_imdb_ids) == 0:
+        return
+
+    print('Looking up the tmdb id of ' + str(len(missing_imdb_ids)) + ' movies with an imdb id.')
+    missing_imdb_ids = sorted(missing_imdb_ids)
+    chunk_size = 100
+    download_threads = max(global_settings.getint('download_threads', 8), 1)
+    for chunk_start in range(0, len(missing_imdb_ids), chunk_size):
+        found_movie_ids = map_in_threads(prefetch_tmdb_movie_id, missing_imdb_ids[chunk_start:chunk_start + chunk_size],
+                                         download_threads)
+        remember_movie_ids([movie_ids for movie_ids in found_movie_ids if movie_ids is not None])
+        if connection_lost_event.is_set():
+            raise ConnectionLostError('Lost internet connection.')
+
+
+def prefetch_tmdb_movie_id(imdb_id):
+    # returns: (imdb id, tmdb id) or None if the lookup failed.
+
+    try:
+        data = retrieve_web_data(tmdb_url('find', imdb_id, 'en-US'), 'tmdb id')
+    except (ValueError, ConnectionLostError) as e:
+        print(e)
+        return None
+    return imdb_id, get_tmdb_id_from_find_results(json.loads(data.decode('utf-8')))
+
+
+def remember_movie_ids(movie_ids):
+    # movie_ids: [(imdb id, tmdb id or None), ...]
+
+    movie_ids = [(imdb_id, tmdb_id) for imdb_id, tmdb_id in movie_ids if imdb_id is not None and len(imdb_id) == 9]
+    if len(movie_ids) == 0:
+        return
+    for imdb_id, tmdb_id in movie_ids:
+        movie_id_map[imdb_id] = tmdb_id
+        if tmdb_id is not None:
+            imdb_id_map[tmdb_id] = imdb_id
+
+    if cache_settings.getboolean('enable_cache', False):
+        cache = open_cache()
+        now = time.time()
+        cache.executemany('INSERT OR REPLACE INTO movie_ids (imdb_id, tmdb_id, resolved_at) '
+                          'VALUES (?, ?, ?)', [(imdb_id, tmdb_id, now,) for imdb_id, tmdb_id in movie_ids])
+        cache.commit()
+
+
+def get_tmdb_languages(settings):
+    # returns: the languages in the order the category tries them.
 
+    if settings.getboolean('prefer_secondary_language', False) and secondary_language in tmdb_languages:
+        return [secondary_language] + [language for language in tmdb_languages if language != secondary_language]
+    return tmdb_languages
 
-def get_secondary_tmdb_movie_metadata(movie):
-    global secondary_tmdb_movie_metadata
+
+def get_tmdb_movie_metadata(movie, language=None):
+    # returns: the metadata of the movie in the language, the main language if none is given.
+    # With translations appended every other language is built from the main language metadata.
+
+    if language is None:
+        language = main_language
+    if language in tmdb_movie_metadata:
+        return tmdb_movie_metadata[language]
+
+    if language != main_language and 'translations' in tmdb_appends['movie']:
+        tmdb_movie_metadata[language] = get_translated_tmdb_metadata(get_tmdb_movie_metadata(movie), language)
+        return tmdb_movie_metadata[language]
 
     if movie['tmdb_id'] is None:
         get_tmdb_movie_id(movie)
 
-    response = retrieve_web_page('https://api.themoviedb.org/3/movie/'
-                                 + movie['tmdb_id'] +
-                                 '?api_key=' + tmdb_api_key +
-                                 '&language=' + secondary_language, 'Secondary language movie metadata from tmdb')
-    secondary_tmdb_movie_metadata = json.loads(response.read().decode('utf-8'))
+    data = retrieve_tmdb_data('movie', movie['tmdb_id'], language, language + ' movie metadata from tmdb')
+    tmdb_movie_metadata[language] = json.loads(data.decode('utf-8'))
     if movie['imdb_id'] is None:
-        movie['imdb_id'] = secondary_tmdb_movie_metadata['imdb_id']
-    response.close()
+        movie['imdb_id'] = tmdb_movie_metadata[language]['imdb_id']
+        remember_movie_ids([(movie['imdb_id'], movie['tmdb_id'])])
+    return tmdb_movie_metadata[language]
+
+
+def get_translated_tmdb_metadata(metadata, language):
+    # Builds the metadata in another language out of the appended translations,
+    # the same way tmdb answers when asked for that language.
+
+    translations = dict()
+    for translation in metadata['translations']['translations']:
+        translations[translation['iso_639_1'] + '-' + translation['iso_3166_1']] = translation['data']
+        translations.setdefault(translation['iso_639_1'], translation['data'])
+    translation = translations.get(language, dict())
+    default_translation = translations.get('en-US', dict())
+
+    # movies have a title, collections have a name.
+    title_key = 'title' if 'title' in metadata else 'name'
+    translated_metadata = dict(metadata)
+    translated_metadata[title_key] = translation.get('title') or translation.get('name') \
+        or default_translation.get('title') or default_translation.get('name') \
+        or metadata.get('original_' + title_key, metadata[title_key])
+    for key in ('tagline', 'overview'):
+        if key in metadata:
+            translated_metadata[key] = translation.get(key) or ''
+    return translated_metadata
+
+
+def get_tmdb_content_rating(movie_metadata, country):
+    # returns: the first certification for the country in the appended release dates, None if there is none.
+
+    for release_country in movie_metadata['release_dates']['results']:
+        if release_country['iso_3166_1'].upper() != country.upper():
+            continue
+        for release_date in release_country['release_dates']:
+            if release_date['certification'] != '':
+                return release_date['certification']
+    return None
 
 
-def get_tmdb_collection_metadata(collection):
-    global tmdb_collection_metadata
+def register_collection(collection_id):
 
-    response = retrieve_web_page('https://api.themoviedb.org/3/collection/' + str(collection['collection_id']) +
-                                 '?api_key=' + tmdb_api_key +
-                                 '&language=' + main_language, 'Main language collection metadata from tmdb')
+    if collection_id not in collection_registry:
+        collection_registry[collection_id] = {'metadata': dict(), 'downloaded_images': set()}
+    return collection_registry[collection_id]
 
-    tmdb_collection_metadata = json.loads(response.read().decode('utf-8'))
 
-    response.close()
+def get_tmdb_collection_of_movie(movie, collection, settings):
+    # Fills in the tmdb id and the title of the collection the movie belongs to.
+    # returns: the collection metadata, None if the movie isn't in a collection.
 
+    collection_language = get_tmdb_languages(settings)[0]
+    movie_metadata = get_tmdb_movie_metadata(movie, collection_language)
 
-def get_secondary_tmdb_collection_metadata(collection):
-    global secondary_tmdb_collection_metadata
+    if movie_metadata['belongs_to_collection'] is None:
+        return None
 
-    response = retrieve_web_page('https://api.themoviedb.org/3/collection/' + str(collection['collection_id']) +
-                                 '?api_key=' + tmdb_api_key +
-                                 '&language=' + secondary_language, 'Secondary language collection metadata from tmdb')
+    collection['collection_id'] = movie_metadata['belongs_to_collection']['id']
+    collection['title'] = movie_metadata['belongs_to_collection']['name']
 
-    secondary_tmdb_collection_metadata = json.loads(response.read().decode('utf-8'))
+    collection_metadata = get_tmdb_collection_metadata(collection, collection_language)
+    # movie metadata built from translations have the collection name in the main language.
+    collection['title'] = collection_metadata.get('name', collection['title'])
 
-    response.close()
+    return collection_metadata
+
+
+def score_collections(collection_ids, settings):
+    # Scores the movies of all the collections in one go and keeps the scores in the collection registry.
+    # example: 'score': {'movie_count': 3, 'total_score': 22.5, 'viable': True}
+    # movie_count is the movies with enough votes and a good enough score, total_score is the sum of all scores.
+
+    collection_ids = [collection_id for collection_id in collection_ids
+                      if 'score' not in register_collection(collection_id)]
+    if len(collection_ids) == 0:
+        return
+
+    minimum_movie_vote_count = settings.getint('minimum_movie_vote_count')
+    minimum_movie_score = settings.getfloat('minimum_movie_score', 0)
+    minimum_total_score = settings.getint('minimum_total_score')
+    minimum_movie_count = settings.getint('minimum_movie_count')
+
+    collection_index = list()
+    vote_counts = list()
+    vote_averages = list()
+    for index, collection_id in enumerate(collection_ids):
+        for coll_movie in get_any_tmdb_collection_metadata({'collection_id': collection_id})['parts']:
+            collection_index.append(index)
+            vote_counts.append(coll_movie['vote_count'])
+            vote_averages.append(coll_movie['vote_average'])
+
+    if numpy_installed:
+        collection_index = numpy.array(collection_index, dtype=numpy.int64)
+        vote_averages = numpy.array(vote_averages, dtype=numpy.float64)
+        good_movies = (numpy.array(vote_counts, dtype=numpy.float64) > minimum_movie_vote_count) \
+            & (vote_averages >= minimum_movie_score)
+        movie_counts = numpy.bincount(collection_index, weights=good_movies,
+                                      minlength=len(collection_ids)).astype(numpy.int64).tolist()
+        total_scores = numpy.bincount(collection_index, weights=vote_averages,
+                                      minlength=len(collection_ids)).tolist()
+    else:
+        movie_counts = [0] * len(collection_ids)
+        total_scores = [0] * len(collection_ids)
+        for index, vote_count, vote_average in zip(collection_index, vote_counts, vote_averages):
+            if vote_count > minimum_movie_vote_count and vote_average >= minimum_movie_score:
+                movie_counts[index] += 1
+            total_scores[index] += vote_average
+
+    for collection_id, movie_count, total_score in zip(collection_ids, movie_counts, total_scores):
+        register_collection(collection_id)['score'] = {
+            'movie_count': movie_count,
+            'total_score': total_score,
+            'viable': total_score >= minimum_total_score and movie_count >= minimum_movie_count}
+
+
+def get_tmdb_collection_metadata(collection, language=None):
+    # returns: the metadata of the collection in the language, the main language if none is given.
+
+    if language is None:
+        language = main_language
+    registered_metadata = register_collection(collection['collection_id'])['metadata']
+    if language in registered_metadata:
+        return registered_metadata[language]
+
+    if language != main_language and 'translations' in tmdb_appends['collection']:
+        registered_metadata[language] = get_translated_tmdb_metadata(get_tmdb_collection_metadata(collection),
+                                                                     language)
+    else:
+        data = retrieve_tmdb_data('collection', collection['collection_id'], language,
+                                  language + ' collection metadata from tmdb')
+        registered_metadata[language] = json.loads(data.decode('utf-8'))
+    return registered_metadata[language]
+
+
+def get_any_tmdb_collection_metadata(collection):
+    # returns: the collection metadata in whichever language is already there, for the language neutral stuff.
+
+    registered_metadata = register_collection(collection['collection_id'])['metadata']
+    for language in tmdb_languages:
+        if language in registered_metadata:
+            return registered_metadata[language]
+    return get_tmdb_collection_metadata(collection)
 
 
 def get_imdb_content_rating(movie, country):
-    response = retrieve_web_page("https://www.imdb.com/title/" + movie['imdb_id'] +
-                                 "/parentalguide?ref_=tt_ql_stry_5", 'certification page on imdb')
-    data = response.read()
-    response.close()
-    soup = BeautifulSoup(data, features="html.parser")
-    cert = str(soup.findAll("a", {"href": lambda l: l and l.startswith('/search/title?certificates=' + country + ':')}))
-    try:
-        cert = cert.split(':')[1].split('"')[0]
-    except IndexError:
+    certificates = get_imdb_certificates(movie['imdb_id'])
+    if country not in certificates:
         print('The movie "' + movie['title'] + '" don\'t have a content rating on imdb for this country.')
-        cert = ':-???-:'
+        return ':-???-:'
+
+    return certificates[country]
 
-    return cert
+
+def get_imdb_certificates(imdb_id):
+    # returns: {country code: certificate} for every country that has a certificate on imdb.
+
+    if imdb_id not in imdb_certificates:
+        data = get_cached_tmdb_data('certificates', imdb_id, '')
+        if data is None:
+            certificates = download_imdb_certificates(imdb_id)
+            cache_tmdb_data('certificates', imdb_id, '', json.dumps(certificates).encode('utf-8'))
+        else:
+            certificates = json.loads(data.decode('utf-8'))
+        imdb_certificates[imdb_id] = certificates
+
+    return imdb_certificates[imdb_id]
+
+
+def download_imdb_certificates(imdb_id):
+    # The parental guide is scanned for the certificate links while it's downloading. The links are all in
+    # one list near the top of the page, so the download stops a little after the last one is found.
+
+    response = retrieve_web_page(imdb_parental_guide_url(imdb_id), 'certification page on imdb', stream=True)
+    certificates = dict()
+    page = b''
+    scanned_since_last_certificate = 0
+    try:
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            page += chunk
+            last_certificate_end = 0
+            for certificate in imdb_certificate_pattern.finditer(page):
+                if certificate.end() == len(page):
+                    # might be cut off by the end of the chunk, it's found again with the next one.
+                    break
+                country = certificate.group(1).decode('utf-8')
+                if country not in certificates:
+                    certificates[country] = unquote(certificate.group(2).decode('utf-8', 'replace'))
+                last_certificate_end = certificate.end()
+
+            if last_certificate_end > 0:
+                scanned_since_last_certificate = len(page) - last_certificate_end
+            else:
+                scanned_since_last_certificate += len(chunk)
+            if len(certificates) > 0 and scanned_since_last_certificate > 64 * 1024:
+                break
+            page = page[max(last_certificate_end, len(page) - 256):]
+    except RequestException as e:
+        raise ValueError('Failed to download certification page on imdb : ' + str(e) + '. Skipping.')
+    finally:
+        response.close()
+
+    return certificates
+
+
+def prefetch_imdb_certificates(imdb_id):
+
+    try:
+        return download_imdb_certificates(imdb_id)
+    except (ValueError, ConnectionLostError) as e:
+        print(e)
+        return None
 
 
 def add_to_commit_list(commit_list, entry_id, key, value):
@@ -1110,47 +2838,59 @@ def delete_collection(collection, locks_limit=0):
                        'WHERE metadata_type = 18 '
                        'AND library_section_id = ? '
                        'AND id = ?', (library_key, collection['metadata_id'],))
+        collections = cursor.fetchall()
     else:
-        cursor.execute('SELECT id, [index], user_fields '
-                       'FROM metadata_items '
-                       'WHERE metadata_type = 18 '
-                       'AND library_section_id = ? '
-                       'AND title = ?', (library_key, collection['title'],))
-    for item in cursor.fetchall():
-        if not len(item[2].split('|')) > int(locks_limit):
+        collections = [(item[0], item[3], item[2]) for item in get_collections_by_title(collection['title'])]
+    for item in collections:
+        if not len((item[2] or '').split('|')) > int(locks_limit):
             continue
         delete_commits.append([item[0], item[1]])
 
 
 def tool_remove_empty_collections():
+    # One anti-join finds every collection without taggings.
 
-    cursor.execute('SELECT id, [index] '
-                   'FROM metadata_items ' 
-                   'WHERE metadata_type = 18 '
-                   'AND library_section_id = ?', (library_key,))
-    for collection_id in cursor.fetchall():
-        collection = {'metadata_id': collection_id[0]}
-        cursor.execute('SELECT id '
-                       'FROM taggings '
-                       'WHERE tag_id = ?', (collection_id[1],))
-        if cursor.fetchone() is None:
-            delete_collection(collection)
+    cursor.execute('SELECT metadata_items.id, metadata_items.[index] '
+                   'FROM metadata_items '
+                   'WHERE metadata_items.metadata_type = 18 '
+                   'AND metadata_items.library_section_id = ? '
+                   'AND NOT EXISTS ('
+                   'SELECT 1 '
+                   'FROM taggings '
+                   'WHERE taggings.tag_id = metadata_items.[index])', (library_key,))
+    add_collections_to_delete(cursor.fetchall(), 'with no movies in them')
 
 
 def tool_remove_unlocked_collections():
+    # One query finds every collection without locked fields.
 
-    cursor.execute('SELECT id, [index], user_fields '
+    cursor.execute('SELECT id, [index] '
                    'FROM metadata_items '
                    'WHERE metadata_type = 18 '
-                   'AND library_section_id = ?', (library_key,))
-    for collection_id in cursor.fetchall():
-        collection = {'metadata_id': collection_id[0]}
-        if collection_id[2] is None \
-                or collection_id[2] == '' \
-                or collection_id[2] == 'lockedFields=':
-            delete_collection(collection)
+                   'AND library_section_id = ? '
+                   'AND (user_fields IS NULL '
+                   'OR user_fields = \'\' '
+                   'OR user_fields = \'lockedFields=\')', (library_key,))
+    add_collections_to_delete(cursor.fetchall(), 'with no locked fields')
 
 
+def add_collections_to_delete(collections, description):
+    # collections: [(metadata item id, tag id), ...]
+
+    already_deleted = set(item[0] for item in delete_commits)
+    new_collections = [[item[0], item[1]] for item in collections if item[0] not in already_deleted]
+    delete_commits.extend(new_collections)
+    print('Found ' + str(len(collections)) + ' collections ' + description + ', ' +
+          str(len(new_collections)) + ' of them not already marked for deletion. ' +
+          str(len(delete_commits)) + ' collections will be deleted.')
+
+
+load_rule_tables()
+
+if arguments.apply is not None:
+    apply_plan(arguments.apply)
+    sys.exit()
+
 if config['TOOLS'].getboolean('delete_collections_no_movies'):
     tool_remove_empty_collections()
 if config['TOOLS'].getboolean('delete_collections_no_locks'):
@@ -1168,6 +2908,8 @@ if not (config['TOOLS'].getboolean('delete_collections_no_locks')
     #     print("It's still safe to save what have already been worked out.")
     #     print('----------------------------------------------------------------------------------------')
     #     commit_to_database()
+elif arguments.plan_out is not None:
+    save_plan(arguments.plan_out)
 else:
     commit_to_database()
 